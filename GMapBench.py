@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import io
+import json
+import time
+import random
+import shutil
+import tempfile
+import resource
+import subprocess
+import threading
+from optparse import OptionParser
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import googlemaps
+from PIL import Image
+
+''' Offline benchmark for GMapView. A local stand-in for the Google geocode, directions,
+    Street View image/metadata and Static Maps endpoints is started in-process and GMapView
+    is pointed at it with APIBASE, so no API quota is used. Each (scenario, size) case runs
+    in its own process so that peak RSS is measured per case '''
+
+SCENARIOS = ['ptlst','p2p','kml','directions']
+SIZES = [10,1000,10000]
+
+def main():
+    parser = OptionParser(usage="python GMapBench.py [options]")
+    parser.add_option("-s", "--scenarios", dest="scenarios", default=",".join(SCENARIOS),
+        help="use STRING as scenario list (comma separated list of {})".format(SCENARIOS), metavar="STRING")
+    parser.add_option("-N", "--sizes", dest="sizes", default=",".join(str(size) for size in SIZES),
+        help="use STRING as list of route sizes in points (comma separated list)", metavar="STRING")
+    parser.add_option("-n", "--concurrency", dest="concurrency", default="8",
+        help="use INT as GMapView CONCURRENCY", metavar="INT")
+    parser.add_option("-l", "--latency", dest="latency", default="0.02",
+        help="use FLOAT as mean stub response latency in seconds", metavar="FLOAT")
+    parser.add_option("-e", "--errors", dest="errors", default="0.0",
+        help="use FLOAT as fraction of stub responses that are HTTP 503", metavar="FLOAT")
+    parser.add_option("-i", "--imgsize", dest="imgsize", default="600x300",
+        help="use STRING as the size of stub images", metavar="STRING")
+    parser.add_option("-j", "--jsonconfig", dest="jsonconfig", default=None,
+        help="use FILE.json for extra GMapView settings", metavar="FILE.json")
+    parser.add_option("-o", "--output", dest="output", default="bench_output.json",
+        help="write results to FILE as JSON", metavar="FILE")
+    parser.add_option("--single", action="store_true", dest="single", default=False,
+        help="(internal) run one case and print its result")
+    (options, _) = parser.parse_args()
+
+    stubopts = {'latency':float(options.latency),'errors':float(options.errors),'imgsize':options.imgsize}
+    extra = {}
+    if options.jsonconfig is not None:
+        with open(options.jsonconfig) as jfile:
+            extra = json.load(jfile)
+    extra['CONCURRENCY'] = int(options.concurrency)
+    extra['IMGSIZE'] = options.imgsize
+
+    if options.single:
+        print(json.dumps(runCase(options.scenarios,int(options.sizes),stubopts,extra)))
+        return
+
+    results = []
+    for size in [int(size) for size in options.sizes.split(",")]:
+        for scenario in options.scenarios.split(","):
+            cmd = [sys.executable,os.path.abspath(__file__),"--single","-s",scenario,"-N",str(size),
+                   "-n",options.concurrency,"-l",options.latency,"-e",options.errors,"-i",options.imgsize]
+            if options.jsonconfig is not None:
+                cmd += ["-j",options.jsonconfig]
+            out = subprocess.run(cmd,stdout=subprocess.PIPE,check=True).stdout.decode()
+            result = json.loads(out.strip().splitlines()[-1])
+            print("{scenario:<11}{points:>7} pts {pts_per_sec:>9.1f} pts/s  p50 {p50_ms:>8.1f} ms  "
+                  "p99 {p99_ms:>8.1f} ms  peak RSS {peak_rss_mb:>7.1f} MB".format(**result))
+            results.append(result)
+    report = {'timestamp':time.time(),'stub':stubopts,'settings':extra,'results':results}
+    with open(options.output,'w') as ofile:
+        json.dump(report,ofile,indent=4)
+
+
+def runCase(scenario,npts,stubopts,extra):
+    ''' Run one scenario of npts points against a fresh stub and measure it '''
+    from GMapView import GMapView, defaultsettings
+    server = startStub(npts=npts,**stubopts)
+    workdir = tempfile.mkdtemp(prefix="gmapbench_")
+    try:
+        settings = dict(defaultsettings)
+        ''' No USAGEFILE: the scheduler saves it at exit, after workdir is gone '''
+        settings.update({'GAPIKEY':'AIzaBenchmarkKey','APIBASE':'http://127.0.0.1:{}'.format(server.server_port),
+                         'IMGDIR':os.path.join(workdir,'images'),'ADDRESSFILE':os.path.join(workdir,'addresses.json'),
+                         'USAGEFILE':'','INDEXFILE':os.path.join(workdir,'images.sqlite'),
+                         'PLOTON':False,'LOGLEVEL':'ERROR','HTTPBACKOFF':0.01})
+        settings.update(extra)
+        configfile = os.path.join(workdir,'config.json')
+        with open(configfile,'w') as jfile:
+            json.dump(settings,jfile)
+        gmsv = GMapView(configfile=configfile)
+
+        ''' Time every point as it goes through the pipeline '''
+        latencies = []
+        runPt = gmsv.runPt
+        def timedRunPt(pt,rtname,**kwargs):
+            start = time.perf_counter()
+            try:
+                return runPt(pt,rtname,**kwargs)
+            finally:
+                latencies.append(time.perf_counter() - start)
+        gmsv.runPt = timedRunPt
+
+        ptlst = stubRoute(npts)
+        start = time.perf_counter()
+        if scenario == 'ptlst':
+            gmsv.runPtLst(ptlst,'BENCH')
+        elif scenario == 'p2p':
+            gmsv.runPt2Pt([[ptlst[0]['lng'],ptlst[0]['lat']],[ptlst[-1]['lng'],ptlst[-1]['lat']]],'BENCH',npts - 2)
+        elif scenario == 'kml':
+            kmlfile = os.path.join(workdir,'route.kml')
+            writeKML(kmlfile,ptlst,'BENCH')
+            gmsv.runKML(kmlfile,'BENCH')
+        elif scenario == 'directions':
+            gmsv.runDirections("start='A';end='B'",'BENCH')
+        else:
+            raise ValueError("Unknown scenario {}".format(scenario))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir,ignore_errors=True)
+    latencies.sort()
+    return {'scenario':scenario,
+            'points':len(latencies),
+            'seconds':elapsed,
+            'pts_per_sec':len(latencies)/elapsed if elapsed > 0 else 0.0,
+            'p50_ms':1000*percentile(latencies,50),
+            'p99_ms':1000*percentile(latencies,99),
+            'peak_rss_mb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,
+            'metrics':gmsv.metrics.snapshot()}
+
+def percentile(sortedlst,pct):
+    if not sortedlst:
+        return 0.0
+    return sortedlst[min(len(sortedlst) - 1,int(round(pct/100.0*(len(sortedlst) - 1))))]
+
+def stubRoute(npts,lat=40.4500,lng=-79.9400,step=0.0001):
+    ''' A straight test route of npts points, about 11m apart '''
+    return [{'lat':lat + ii*step,'lng':lng + ii*step/2} for ii in range(npts)]
+
+def writeKML(kmlfile,ptlst,name):
+    coords = " ".join("{},{},0".format(pt['lng'],pt['lat']) for pt in ptlst)
+    with open(kmlfile,'w') as kfile:
+        kfile.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+                    '<Placemark><name>{}</name><LineString><coordinates>{}</coordinates></LineString></Placemark>'
+                    '</Document></kml>\n'.format(name,coords))
+
+
+''' The Google endpoint stand-in '''
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    errors = 0.0
+    npts = 10
+    jpeg = b""
+    png = b""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key:value[0] for key, value in parse_qs(url.query).items()}
+        if self.latency:
+            time.sleep(random.expovariate(1.0/self.latency))
+        if self.errors and random.random() < self.errors:
+            return self.reply(503,b'{"status":"UNKNOWN_ERROR"}',"application/json")
+        if url.path == "/maps/api/geocode/json":
+            loc = stubRoute(1)[0]
+            return self.replyJSON({'status':'OK','results':[{'geometry':{'location':loc}}]})
+        if url.path == "/maps/api/directions/json":
+            return self.replyJSON(stubDirections(self.npts))
+        if url.path == "/maps/api/streetview/metadata":
+            if 'pano' in query:
+                return self.replyJSON({'status':'OK','pano_id':query['pano']})
+            lat, lng = [float(coord) for coord in query['location'].split(",")]
+            return self.replyJSON({'status':'OK','pano_id':"PANO{:.4f}_{:.4f}".format(lat,lng),
+                                   'location':{'lat':lat,'lng':lng},'date':'2020-01'})
+        if url.path == "/maps/api/streetview":
+            return self.reply(200,self.jpeg,"image/jpeg")
+        if url.path == "/maps/api/staticmap":
+            return self.reply(200,self.png,"image/png")
+        return self.reply(404,b"",None)
+
+    def replyJSON(self,obj):
+        self.reply(200,json.dumps(obj).encode(),"application/json")
+
+    def reply(self,status,body,ctype):
+        self.send_response(status)
+        if ctype is not None:
+            self.send_header("Content-Type",ctype)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,*args):
+        pass
+
+def stubDirections(npts):
+    ptlst = stubRoute(npts)
+    steps = [{'start_location':pt1,'end_location':pt2} for pt1, pt2 in zip(ptlst[:-1],ptlst[1:])]
+    return {'status':'OK','routes':[{'legs':[{'steps':steps}],
+            'overview_polyline':{'points':googlemaps.convert.encode_polyline(ptlst)}}]}
+
+def stubImage(size,fmt):
+    width, height = [int(dim) for dim in size.split("x")]
+    im = Image.effect_noise((width,height),64).convert('RGB')
+    out = io.BytesIO()
+    im.save(out,fmt)
+    return out.getvalue()
+
+def startStub(latency=0.0,errors=0.0,imgsize="600x300",npts=10):
+    ''' Start the stub server on a free local port in a background thread '''
+    handler = type("ConfiguredStubHandler",(StubHandler,),
+                   {'latency':latency,'errors':errors,'npts':npts,
+                    'jpeg':stubImage(imgsize,'JPEG'),'png':stubImage("640x640",'PNG')})
+    server = ThreadingHTTPServer(("127.0.0.1",0),handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server
+
+
+if __name__ == '__main__': main()
@@ -7,18 +7,67 @@ import time
 import json
 import requests
 import random
+import shutil
+import tempfile
+import uuid
+import io
+import queue
+import atexit
+import hashlib
+import sqlite3
+import threading
+import re
+import csv
+import zipfile
+import tarfile
+import heapq
+import itertools
+import importlib
+from collections import deque, OrderedDict
+from array import array
+from contextlib import contextmanager, ExitStack
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import socketserver
+import signal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from optparse import OptionParser
 import logging
+try:
+    import fcntl
+except ImportError:
+    ''' No advisory file locks (Windows): shared files are then only safe for one process '''
+    fcntl = None
 
-from GPSPhoto import gpsphoto
-import googlemaps
-import google_streetview.api
-import xmltodict
-from PIL import Image
-from math import ceil
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1 import ImageGrid
+from math import ceil, degrees, radians, cos, sin, asin, sqrt
+
+class LazyImport(object):
+    ''' Stand-in for a module that is only imported when one of its attributes is first used,
+        so that a headless run never pays for matplotlib, PIL, numpy or the KML parser '''
+    def __init__(self,name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self,attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module,attr)
+
+googlemaps = LazyImport("googlemaps")
+piexif = LazyImport("piexif")
+np = LazyImport("numpy")
+Image = LazyImport("PIL.Image")
+ImageDraw = LazyImport("PIL.ImageDraw")
+plt = LazyImport("matplotlib.pyplot")
+axes_grid1 = LazyImport("mpl_toolkits.axes_grid1")
+ElementTree = LazyImport("xml.etree.ElementTree")
 LOGNAME="gmaputillog"
+APIBASE = "https://maps.googleapis.com"
+USAGEFILE = "./gmapusage.json"
+MAXURLLEN = 8192
+RETRYSTATUS = (429,500,502,503,504)
+MAXSHARDFILES = 256
 
 def main():
     ''' Main consists of two parts: the command line interface to the API 
@@ -36,6 +85,9 @@ def main():
           -p INT, --points=INT  use INT as # of points in a p2p test
           -P, --plot            Plot the downloaded images
           -C, --clean           Delete downloaded images before exit
+          -n INT, --concurrency=INT
+                                use INT as # of points downloaded in parallel
+          --profile             Print a per-stage timing summary at exit
           -t STRING, --test=STRING
                                 use STRING as test list (comma separated list); 'all'
                                 to run all tests; 'list' to get valid tests)
@@ -45,6 +97,24 @@ def main():
                                 use STRING as street address
           -R STRING, --route=STRING
                                 use STRING as start=<START ADDRESS>;end=<END ADDRESS>
+          -J FILE, --job=FILE   run the rows of FILE (.csv or .jsonl) and exit
+          -O FILE, --output=FILE
+                                write per-row job results to FILE (default
+                                <job>.results.jsonl)
+          -Q LAT,LNG,RADIUS, --query=LAT,LNG,RADIUS
+                                print the saved images within RADIUS metres of LAT,LNG
+                                (-d to pick headings) and exit
+          -K FILE, --kml=FILE   use every Placemark of FILE (.kml or .kmz) as the
+                                points to --plan
+          --serve=ADDRESS       serve requests on ADDRESS (host:port or unix:/path)
+                                until interrupted
+          --plan=DIR            split the points of -J, -K or -R into geohash shards
+                                in DIR and exit
+          --worker=DIR          run the shard given by --shard (default every
+                                unfinished shard) of DIR and exit
+          --shard=STRING        use STRING as the shard (geohash cell) for --worker
+          --merge=DIR           merge the shard results of DIR into
+                                DIR/results.jsonl (or -O FILE) and exit
 
      '''
 
@@ -69,6 +139,10 @@ def main():
         help="Plot the downloaded images")
     parser.add_option("-C", "--clean", action="store_true", dest="clean", default=None, 
         help="Delete downloaded images before exit")
+    parser.add_option("-n", "--concurrency", dest="concurrency",
+        help="use INT as # of points downloaded in parallel", metavar="INT")
+    parser.add_option("--profile", action="store_true", dest="profile", default=False,
+        help="Print a per-stage timing summary at exit")
  
         
     ''' Set Testing Variables '''
@@ -80,6 +154,30 @@ def main():
         help="use STRING as street address", metavar="STRING")
     parser.add_option("-R", "--route", dest="rtestr",
         help="use STRING as start=<START ADDRESS>;end=<END ADDRESS>", metavar="STRING")     
+    
+    ''' Batch jobs '''
+    parser.add_option("-J", "--job", dest="jobfile",
+        help="run the rows of FILE (.csv or .jsonl) and exit", metavar="FILE")
+    parser.add_option("-O", "--output", dest="joboutput",
+        help="write per-row job results to FILE (default <job>.results.jsonl)", metavar="FILE")
+    parser.add_option("-Q", "--query", dest="query",
+        help="print the saved images within RADIUS metres of LAT,LNG (-d to pick headings) and exit", metavar="LAT,LNG,RADIUS")
+    parser.add_option("-K", "--kml", dest="kmlfile",
+        help="use every Placemark of FILE (.kml or .kmz) as the points to --plan", metavar="FILE")
+
+    ''' Service mode '''
+    parser.add_option("--serve", dest="serve",
+        help="serve requests on ADDRESS (host:port or unix:/path) until interrupted", metavar="ADDRESS")
+
+    ''' Sharded runs '''
+    parser.add_option("--plan", dest="plandir",
+        help="split the points of -J, -K or -R into geohash shards in DIR and exit", metavar="DIR")
+    parser.add_option("--worker", dest="workerdir",
+        help="run the shard given by --shard (default every unfinished shard) of DIR and exit", metavar="DIR")
+    parser.add_option("--shard", dest="shard",
+        help="use STRING as the shard (geohash cell) for --worker", metavar="STRING")
+    parser.add_option("--merge", dest="mergedir",
+        help="merge the shard results of DIR into DIR/results.jsonl (or -O FILE) and exit", metavar="DIR")
     (options, _) = parser.parse_args()
 
     ''' Instantiate the API '''
@@ -88,6 +186,9 @@ def main():
     else:
         gmsv = GMapView(GAPIKEY=options.gapikey)
 
+    if options.profile:
+        atexit.register(lambda: print(gmsv.metrics.summary()))
+
     ''' Override options from command line '''
     if options.plot is not None:
         gmsv.setSetting("PLOTON", options.plot)
@@ -102,6 +203,11 @@ def main():
             gmsv.setSetting("LINEPTS",int(options.linepts))
         except:
             logging.error("Invalid value for LINEPTS; using default. {}".format(gmsv.getSetting("LINEPTS")))
+    if options.concurrency is not None:
+        try:
+            gmsv.setSetting("CONCURRENCY",int(options.concurrency))
+        except:
+            gmsv.logger.error("Invalid value for CONCURRENCY; using default. {}".format(gmsv.getSetting("CONCURRENCY")))
     if options.pitch is not None:
         try:
             gmsv.setSetting("PITCH",float(options.pitch))
@@ -129,6 +235,53 @@ def main():
     else:
         rtestr = defrtstr
     
+    if options.serve is not None:
+        GMapService(gmsv,options.serve).serve()
+        sys.exit(0)
+
+    if options.query is not None:
+        try:
+            lat, lng, radius = [float(val) for val in options.query.split(",")]
+        except ValueError:
+            gmsv.logger.error("Invalid query {}; use LAT,LNG,RADIUS".format(options.query))
+            sys.exit(1)
+        headings = options.headinglist.split(",") if options.headinglist is not None else None
+        for res in gmsv.queryImages(lat,lng,radius,headings):
+            print(json.dumps(res))
+        sys.exit(0)
+
+    if options.plandir is not None:
+        if options.jobfile is not None:
+            gmsv.planShards(gmsv.getJobPoints(options.jobfile),options.plandir,
+                            os.path.splitext(os.path.basename(options.jobfile))[0])
+        elif options.kmlfile is not None:
+            gmsv.planShards(gmsv.getKMLPoints(options.kmlfile,namefilter=".*"),options.plandir,
+                            os.path.splitext(os.path.basename(options.kmlfile))[0])
+        elif options.rtestr is not None:
+            ptlst = gmsv.getDirections(rtestr)
+            if ptlst == -1:
+                sys.exit(1)
+            gmsv.planShards(ptlst,options.plandir,'ROUTE')
+        else:
+            gmsv.logger.error("--plan needs a job file (-J), kml file (-K) or route (-R)")
+            sys.exit(1)
+        sys.exit(0)
+
+    if options.workerdir is not None:
+        if options.shard is not None:
+            gmsv.runShard(options.workerdir,options.shard)
+        else:
+            gmsv.runShards(options.workerdir)
+        sys.exit(0)
+
+    if options.mergedir is not None:
+        summary = gmsv.mergeShards(options.mergedir,outfile=options.joboutput)
+        sys.exit(1 if summary['missing'] else 0)
+
+    if options.jobfile is not None:
+        gmsv.runJob(options.jobfile,outfile=options.joboutput)
+        sys.exit(0)
+
     ''' The following code tests the different API options by running a test case '''
     ''' Select which tests to run '''
     if options.testlist is None:
@@ -173,24 +326,49 @@ def main():
 class GMapView(object):
     def __init__(self, GAPIKEY = None, configfile = "./gmapconfig.json", **kwargs):
         self.logger = self.configureLogging()
+        self.metrics = Metrics()
         self.configfile = configfile
+        self.local = threading.local()
         self.settings = None
         self.setDefaults(GAPIKEY=GAPIKEY)
         self.addressfile = self.settings["ADDRESSFILE"] if "ADDRESSFILE" in self.settings else "./gmapaddresses.json"
 
         if 'GAPIKEY' in self.settings:
             self.GAPIKEY = self.settings['GAPIKEY']
-            self.gmapsclient = googlemaps.Client(key=self.GAPIKEY)
+            self.scheduler = QuotaScheduler(self.settings,logger=self.logger)
+            self.configureHttp()
+            self.gmapsclient = None
         else:
             self.logger.error("No GAPIKEY")
             sys.exit(1)
-        if os.path.isfile(self.addressfile):
-            with open(self.addressfile) as jfile:
-                self.addressdict = json.load(jfile)
-        else:
-            self.logger.info("%s does not exist" % self.addressfile)
-            self.addressdict = {'addresses':{}}
+        self.addressstore = GeocodeStore(self.addressfile, logger=self.logger)
+        self.addressdict = {'addresses':self.addressstore.addresses}
         self.testset = self.setTestData()
+        ''' dumpMetrics checks METRICSFILE and PROMFILE at exit, so they can be set later '''
+        atexit.register(self.dumpMetrics)
+        self.contactsheets = None
+        self.sheetlock = threading.RLock()
+        self.tarwriter = None
+        self.derivatives = None
+        self.tarlock = threading.Lock()
+        self.hashindex = None
+        self.placeholders = list(self.getSetting("PLACEHOLDERHASHES") or [])
+        if self.getSetting("DEDUP"):
+            self.hashindex = HashIndex(int(self.getSetting("DEDUPDISTANCE") or 0),
+                    hashfile=self.getSetting("DEDUPFILE") or None,logger=self.logger)
+        self.spatialindex = None
+        if self.getSetting("INDEXFILE"):
+            self.spatialindex = SpatialIndex(self.settings["INDEXFILE"],logger=self.logger)
+        self.imagecache = None
+        if self.getSetting("CACHEDIR"):
+            self.imagecache = ImageCache(self.settings["CACHEDIR"],
+                    int(self.getSetting("CACHESIZE") or 1024)*1024*1024, logger=self.logger)
+        self.mapcache = None
+        mapcachedir = self.getSetting("MAPCACHEDIR") or \
+                (os.path.join(self.settings["CACHEDIR"],"maps") if self.getSetting("CACHEDIR") else None)
+        if mapcachedir:
+            self.mapcache = ImageCache(mapcachedir,int(self.getSetting("MAPCACHESIZE") or 256)*1024*1024,
+                    ext=".png",logger=self.logger)
         pass
     
     def setDefaults(self,current_settings = {}, GAPIKEY = None, **kwargs):
@@ -201,7 +379,7 @@ class GMapView(object):
             self.logger.error("No gmapconfig.json and no APIKEY specified")
             return False
         else:
-            self.settings = defaultsettings
+            self.settings = dict(defaultsettings)
         self.settings['HEADINGS'] = self.settings['HEADINGS'].replace(",",";")  # Hack to allow csv for headings
         if GAPIKEY is not None:
             self.settings['GAPIKEY'] = GAPIKEY        
@@ -209,10 +387,53 @@ class GMapView(object):
             self.setLogLevel(self.settings['LOGLEVEL'])
         return True
     
+    @property
+    def settings(self):
+        ''' The settings in effect: this thread's request settings (see requestSettings) if
+            there are any, else the shared settings '''
+        settings = getattr(self.local,'settings',None)
+        return settings if settings is not None else self.basesettings
+
+    @settings.setter
+    def settings(self,value):
+        self.basesettings = value
+
+    @contextmanager
+    def requestSettings(self,overrides):
+        ''' Apply overrides to a copy of the settings for the calls made by this thread (and
+            the pool threads they start) inside the block; the shared settings are untouched '''
+        previous = getattr(self.local,'settings',None)
+        settings = dict(self.settings)
+        settings.update(overrides)
+        if 'HEADINGS' in overrides:
+            settings['HEADINGS'] = str(settings['HEADINGS']).replace(",",";")
+        self.local.settings = settings
+        try:
+            yield settings
+        finally:
+            self.local.settings = previous
+
+    def bindSettings(self,fn):
+        ''' fn wrapped to run with the calling thread's request settings, for handing to
+            another thread '''
+        settings = getattr(self.local,'settings',None)
+        if settings is None:
+            return fn
+        def bound(*args,**kwargs):
+            previous = getattr(self.local,'settings',None)
+            self.local.settings = settings
+            try:
+                return fn(*args,**kwargs)
+            finally:
+                self.local.settings = previous
+        return bound
+
     def setSetting(self,key,value,**kwargs):
         self.settings[key] = value
         if key == "LOGLEVEL":
             self.setLogLevel(value)
+        if key == "CONCURRENCY" and hasattr(self,'session'):
+            self.mountHttpAdapters()
 
     def getSetting(self,key):
         retval = self.settings[key] if key in self.settings else None
@@ -247,28 +468,228 @@ class GMapView(object):
         -- Rename file to unique name
     '''
     
-    def runAddress(self,addr):
+    def runAddress(self,addr,**kwargs):
         ''' Start the pipeline with a single street address '''
-        gc = self.gmapsclient.geocode(addr)
-        locdict = gc[0]['geometry']['location']
+        locdict = self.geocode(addr)
         self.logger.debug("Address \'{}\' is at {}".format(addr,locdict))
-        self.saveAddress(addr, locdict)
-        self.saveResults(self.getResultsGEO(locdict,addr))
+        self.saveResults(self.getResultsGEO(locdict,addr),**kwargs)
         return locdict
 
+    def geocode(self,addr):
+        ''' Look up a street address, using the address store before the geocoding API '''
+        locdict = self.addressstore.get(addr)
+        if locdict is not None:
+            return dict(locdict)
+        self.metrics.incr("api_calls","geocode")
+        with self.scheduler.call("geocode"), self.metrics.timer("geocode"):
+            gc = self.getMapsClient().geocode(addr)
+        if not gc:
+            raise ValueError("No geocoding result for address '{}'".format(addr))
+        locdict = gc[0]['geometry']['location']
+        self.saveAddress(addr, locdict)
+        return dict(locdict)
+
+    def geocodeMany(self,addrlst):
+        ''' Geocode a list of addresses; only addresses missing from the address store are
+            sent to the API (once each, CONCURRENCY at a time). Returns a location per address
+            in order, or None where geocoding failed '''
+        misses = list(dict.fromkeys(addr for addr in addrlst if self.addressstore.get(addr) is None))
+        self.logger.info("Geocoding {} of {} addresses".format(len(misses),len(addrlst)))
+        def geocodeSafe(addr):
+            try:
+                self.geocode(addr)
+            except Exception as e:
+                self.logger.error("Geocoding \'{}\' failed: {}".format(addr,e))
+        concurrency = self.getSetting("CONCURRENCY") or 1
+        if concurrency <= 1:
+            for addr in misses:
+                geocodeSafe(addr)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(self.bindSettings(geocodeSafe),misses))
+        retlst = []
+        for addr in addrlst:
+            locdict = self.addressstore.get(addr)
+            retlst.append(dict(locdict) if locdict is not None else None)
+        return retlst
+
     def runPt(self,pt,rtname,**kwargs):
         ''' Start the pipeline with a single point '''
 #         addr = "%s-latx%3.6flngx%3.6f" % (rtname,pt['lat'],pt['lng'])
-        result = self.getResultsGEO(pt,rtname,**kwargs)
-        self.saveResults(result,**kwargs)
+        with self.metrics.timer("point"):
+            result = self.getResultsGEO(dict(pt),rtname,**kwargs)
+            self.saveResults(result,**kwargs)
+        return result
+
+    def runPtSafe(self,pt,rtname,**kwargs):
+        ''' Run a single point, reporting a failure in the result instead of raising '''
+        try:
+            result = self.runPt(pt,rtname,**kwargs)
+            result['status'] = 'OK'
+        except Exception as e:
+            self.logger.error("Point {} on {} failed: {}".format(gpsdict2pt(pt),rtname,e))
+            result = dict(pt)
+            result['status'] = 'ERROR'
+            result['error'] = str(e)
         return result
+
+    def showResultsSafe(self,result):
+        ''' Display a point of a route, reporting a failure in the result instead of raising.
+            The images are already saved, so the point stays 'OK' with a 'displayerror' '''
+        try:
+            return self.showResults(result)
+        except Exception as e:
+            self.logger.error("Display of {} failed: {}".format(result.get('rtname',gpsdict2pt(result)),e))
+            result['displayerror'] = str(e)
+            return result
     
     def runPtLst(self,ptlst,rtname):
-        ''' Start the pipeline with a list of points '''
+        ''' Start the pipeline with a list of points. With CONCURRENCY > 1 the points are 
+            downloaded by a pool of worker threads. Results keep the order of ptlst and a 
+            point that fails is marked with status 'ERROR' rather than aborting the route.
+            With PANODEDUP each Street View panorama is downloaded only once. With HEADINGMODE
+            'route' the headings are taken relative to the direction of travel '''
+        if self.getSetting("HEADINGMODE") == "route":
+            ptlst = self.addBearings(ptlst)
+        if self.getSetting("PANODEDUP"):
+            pathresult = self.runPanoLst(ptlst,rtname)
+        else:
+            pathresult = self.runPtPool(ptlst,rtname)
+        self.endRouteSheets(rtname)
+        self.showRouteMap(pathresult,rtname)
+        self.logRoute(rtname,len(pathresult),len([res for res in pathresult if res['status'] == 'ERROR']))
+        return pathresult
+
+    def iterPtLst(self,ptlst,rtname):
+        ''' Generator variant of runPtLst for routes of any length: yields a compact PointRecord
+            for each point, in order, as soon as it is done, and keeps nothing else per point.
+            The input points are not modified. With PANODEDUP, panoramas are deduplicated
+            within chunks of PANOCHUNK points '''
+        if self.getSetting("HEADINGMODE") == "route":
+            ptlst = self.addBearings(ptlst)
+        if self.getSetting("PANODEDUP"):
+            chunk = int(self.getSetting("PANOCHUNK") or 1024)
+            ptiter = iter(ptlst)
+            resiter = (res for pts in iter(lambda: list(itertools.islice(ptiter,chunk)),[])
+                       for res in self.runPanoLst(pts,rtname))
+        else:
+            resiter = self.iterPtPool(ptlst,rtname)
+        ''' The only per-point state: 16 bytes for the overview map markers, if it is on '''
+        routemap = array('d') if self.settings['PLOTON'] and self.settings['MAPON'] \
+                and self.getSetting("MAPMODE") == "route" else None
+        npts = 0
+        failed = 0
+        for res in resiter:
+            record = PointRecord.fromResult(res)
+            npts += 1
+            if record.status == 'ERROR':
+                failed += 1
+            elif routemap is not None and record.status == 'OK':
+                routemap.extend((record.lat,record.lng))
+            yield record
+        self.endRouteSheets(rtname)
+        if routemap is not None:
+            self.showRouteMap(({'lat':routemap[ii],'lng':routemap[ii + 1],'status':'OK'}
+                               for ii in range(0,len(routemap),2)),rtname)
+        self.logRoute(rtname,npts,failed)
+
+    def logRoute(self,rtname,npts,failed):
+        if failed:
+            self.logger.error("Route {}: {} of {} points failed".format(rtname,failed,npts))
+        if self.imagecache is not None:
+            self.logger.info("Image cache: {}".format(self.getCacheStats()))
+        if self.hashindex is not None:
+            dropped = self.metrics.snapshot()['counters'].get('images_dropped',{})
+            self.logger.info("Dropped {} placeholder and {} duplicate images so far".format(
+                    dropped.get('placeholder',0),dropped.get('duplicate',0)))
+        self.logger.info("HTTP: {}".format(self.getHttpStats()))
+        self.logger.info("API usage: {}".format(self.scheduler.stats()))
+
+    def runPtPool(self,ptlst,rtname):
+        ''' Run each point through the pipeline, CONCURRENCY points at a time '''
+        return list(self.iterPtPool(ptlst,rtname))
+
+    def iterPtPool(self,ptlst,rtname):
+        ''' Generator over the results of runPtPool, in order, as the points finish '''
+        concurrency = self.getSetting("CONCURRENCY") or 1
+        if concurrency <= 1:
+            for pathpt in ptlst:
+                yield self.showResultsSafe(self.runPtSafe(pathpt,rtname,show=False))
+        else:
+            ''' Keep a bounded window of points in flight; display happens here in order '''
+            runPtSafe = self.bindSettings(self.runPtSafe)
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                pending = deque()
+                for pathpt in ptlst:
+                    pending.append(pool.submit(runPtSafe,pathpt,rtname,show=False))
+                    if len(pending) >= 2*concurrency:
+                        yield self.showResultsSafe(pending.popleft().result())
+                while pending:
+                    yield self.showResultsSafe(pending.popleft().result())
+
+    def runPanoLst(self,ptlst,rtname):
+        ''' Look up the panorama behind every point with the (free) metadata endpoint, download
+            each panorama once and map the images back to every point that snapped to it.
+            Points without imagery are reported with status 'ZERO_RESULTS' and not downloaded '''
+        ptlst = list(ptlst)
+        panolst, memberlst = self.groupByPano(ptlst)
+        if self.getSetting("HEADINGMODE") == "route" and len(panolst) > 1:
+            ''' Panoramas sit on the road, so the bearings between them follow it more closely '''
+            panolst = list(self.addBearings(panolst))
+        self.logger.info("Route {}: {} points resolved to {} panoramas".format(rtname,len(ptlst),len(panolst)))
+        panoresult = self.runPtPool(panolst,rtname)
         pathresult = []
-        for pathpt in ptlst:
-            pathresult.append(self.runPt(pathpt,rtname))
+        for pathpt, member in zip(ptlst,memberlst):
+            if isinstance(member,int):
+                result = dict(panoresult[member])
+                result['pano_location'] = {'lat':result['lat'],'lng':result['lng']}
+                result.update(pathpt)
+            else:
+                result = dict(pathpt)
+                result.update(member)
+            pathresult.append(result)
         return pathresult
+
+    def groupByPano(self,ptlst):
+        ''' Returns the list of distinct panoramas (as points at the panorama location) and,
+            for each input point, either the index of its panorama or a status dict '''
+        concurrency = self.getSetting("CONCURRENCY") or 1
+        if concurrency <= 1:
+            metalst = [self.getPanoMetadataSafe(pathpt) for pathpt in ptlst]
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                metalst = list(pool.map(self.bindSettings(self.getPanoMetadataSafe),ptlst))
+        panolst = []
+        panoidx = {}
+        memberlst = []
+        for pathpt, meta in zip(ptlst,metalst):
+            if meta.get('status') != 'OK':
+                memberlst.append({'status':meta.get('status','ERROR'),'error':meta.get('error_message'),
+                                  'images':[],'files':[]})
+                continue
+            pano_id = meta['pano_id']
+            if pano_id not in panoidx:
+                panoidx[pano_id] = len(panolst)
+                panopt = {'lat':meta['location']['lat'],'lng':meta['location']['lng'],'pano_id':pano_id}
+                for key in ('alt','bearing'):
+                    if key in pathpt:
+                        panopt[key] = pathpt[key]
+                panolst.append(panopt)
+            memberlst.append(panoidx[pano_id])
+        return panolst, memberlst
+
+    def getPanoMetadata(self,pt):
+        ''' Query the Street View metadata endpoint (no charge) for the panorama nearest pt '''
+        params = {'location':"%f,%f" % (pt['lat'],pt['lng']),'key':self.GAPIKEY}
+        r = self.httpGet(self.getApiUrl("/maps/api/streetview/metadata"), params=params)
+        return r.json()
+
+    def getPanoMetadataSafe(self,pt):
+        try:
+            return self.getPanoMetadata(pt)
+        except Exception as e:
+            self.logger.error("Metadata lookup for {} failed: {}".format(gpsdict2pt(pt),e))
+            return {'status':'ERROR','error_message':str(e)}
         
     def runPt2Pt(self,tptlst,rtname,numpts):
         ''' Start the pipeline with a list of points with two points 
@@ -276,32 +697,304 @@ class GMapView(object):
              This code generates intermediate numpts between the begin and end
         '''
         tptptlst = [{'ppt':tptpt,'lat':tptpt[1],'lng':tptpt[0]} for tptpt in tptlst]
-        ptlst = self.getPtList(tptptlst[0],tptptlst[1],numpts)
-        self.runPtLst(ptlst, rtname)
+        if self.getSetting("SPACING"):
+            ptlst = self.getPathPts(tptptlst)
+        else:
+            ptlst = self.getPtList(tptptlst[0],tptptlst[1],numpts)
+        return self.runPtLst(ptlst, rtname)
 
     def saveAddress(self,addr,locdict):
-        self.addressdict['addresses'][addr] = locdict
-        with open(self.addressfile,'w') as jfile:
-            json.dump(self.addressdict,jfile,indent=4)
+        self.addressstore.put(addr,locdict)
     
     def runDirections(self,rtestr, rtname):
-        self.runPtLst(self.getDirections(rtestr),rtname)
-        pass
+        return self.runPtLst(self.getDirections(rtestr),rtname)
     
+    def runJob(self,jobfile,outfile=None,manifest=None):
+        ''' Stream the rows of a job file (.csv with a header line, or .jsonl) through the pipeline.
+            A row has an 'address', a 'lat' and 'lng', or a 'route' (start=...;end=...), and
+            optionally an 'id' and an 'rtname'. Every row gets a status line in outfile; rows
+            that succeed are also recorded in the manifest so a rerun skips them. A route row
+            with failed points is 'PARTIAL' and, like a failed row, is run again next time.
+            With CONCURRENCY > 1 rows run on a pool, except routes, whose points use the pool
+            of runPtLst instead '''
+        outfile = outfile if outfile is not None else jobfile + ".results.jsonl"
+        manifest = manifest if manifest is not None else jobfile + ".done"
+        done = set()
+        if os.path.isfile(manifest):
+            with open(manifest) as mfile:
+                done = set(line.rstrip("\n") for line in mfile)
+            self.logger.info("Resuming job {}: {} rows already done".format(jobfile,len(done)))
+        lock = threading.Lock()
+        counts = {'OK':0,'ERROR':0,'SKIPPED':0}
+        with open(outfile,'a') as ofile, open(manifest,'a') as mfile:
+            def finish(rowkey,status,result=None):
+                ''' Display happens here, in row order, for rows run on the pool '''
+                if result is not None and status['status'] == 'OK':
+                    self.showResultsSafe(result)
+                with lock:
+                    counts['OK' if status['status'] == 'OK' else 'ERROR'] += 1
+                    ofile.write(json.dumps(status) + "\n")
+                    ofile.flush()
+                    if status['status'] == 'OK':
+                        mfile.write(rowkey + "\n")
+                        mfile.flush()
+            def rows():
+                for rowkey, row in self.getJobRows(jobfile):
+                    if rowkey in done:
+                        counts['SKIPPED'] += 1
+                        continue
+                    yield rowkey, row
+            concurrency = self.getSetting("CONCURRENCY") or 1
+            if concurrency <= 1:
+                for rowkey, row in rows():
+                    finish(rowkey,self.runJobRow(rowkey,row)[0])
+            else:
+                runJobRow = self.bindSettings(self.runJobRow)
+                with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    pending = deque()
+                    for rowkey, row in rows():
+                        if row.get('route') and not row.get('address'):
+                            ''' A route runs its own point pool, so it runs here, after the rows before it '''
+                            while pending:
+                                prevkey, future = pending.popleft()
+                                finish(prevkey,*future.result())
+                            finish(rowkey,self.runJobRow(rowkey,row)[0])
+                            continue
+                        pending.append((rowkey,pool.submit(runJobRow,rowkey,row,show=False)))
+                        if len(pending) >= 2*concurrency:
+                            rowkey, future = pending.popleft()
+                            finish(rowkey,*future.result())
+                    while pending:
+                        rowkey, future = pending.popleft()
+                        finish(rowkey,*future.result())
+        self.logger.info("Job {}: {} rows done, {} failed, {} skipped as already done".format(
+                jobfile,counts['OK'],counts['ERROR'],counts['SKIPPED']))
+        return counts
+
+    def getJobRows(self,jobfile):
+        ''' Generator over (row key, row dict) of a .csv or .jsonl job file; the key is the 
+            row's 'id' if it has one, else its row number '''
+        with open(jobfile,newline='') as jfile:
+            if jobfile.lower().endswith(".csv"):
+                reader = csv.DictReader(jfile)
+            else:
+                reader = (json.loads(line) for line in jfile if line.strip())
+            for rownum, row in enumerate(reader,1):
+                rowid = row.get('id')
+                yield str(rowid) if rowid not in (None,"") else str(rownum), row
+
+    def runJobRow(self,rowkey,row,show=True):
+        ''' Run one job row and return its status record, and the point result of an address
+            or lat/lng row (for display by the caller with show=False) '''
+        status = {'row':rowkey,'status':'OK'}
+        result = None
+        try:
+            rtname = row.get('rtname') or "JOB{}".format(rowkey)
+            if row.get('address'):
+                locdict = result = self.runAddress(row['address'],show=show)
+                status.update({'lat':locdict['lat'],'lng':locdict['lng'],'images':locdict.get('images',[])})
+            elif row.get('route'):
+                pathresult = self.runDirections(row['route'],rtname)
+                if pathresult == -1:
+                    raise ValueError("Bad route string: {}".format(row['route']))
+                status['points'] = len(pathresult)
+                status['failed'] = len([res for res in pathresult if res['status'] == 'ERROR'])
+                status['images'] = [im for res in pathresult for im in res.get('images',[])]
+                if status['failed']:
+                    ''' Not checkpointed, so a rerun retries the route '''
+                    status['status'] = 'PARTIAL'
+                    status['error'] = "{} of {} points failed".format(status['failed'],status['points'])
+            elif row.get('lat') not in (None,"") and row.get('lng') not in (None,""):
+                pt = {'lat':float(row['lat']),'lng':float(row['lng'])}
+                if row.get('alt') not in (None,""):
+                    pt['alt'] = int(round(float(row['alt'])))
+                result = self.runPt(pt,rtname,show=show)
+                status.update({'lat':pt['lat'],'lng':pt['lng'],'images':result.get('images',[])})
+            else:
+                raise ValueError("Row has no address, lat/lng or route")
+        except Exception as e:
+            self.logger.error("Job row {} failed: {}".format(rowkey,e))
+            status['status'] = 'ERROR'
+            status['error'] = str(e)
+        return status, result
+
+    def getJobPoints(self,jobfile):
+        ''' Generator over the points of a job file, each tagged with its 'rtname' and 'row'.
+            Addresses are geocoded (through the address store) and routes expanded to their
+            direction points, so a whole job can be planned into shards '''
+        for rowkey, row in self.getJobRows(jobfile):
+            rtname = row.get('rtname') or "JOB{}".format(rowkey)
+            try:
+                if row.get('address'):
+                    ptlst = [self.geocode(row['address'])]
+                elif row.get('route'):
+                    ptlst = self.getDirections(row['route'])
+                    if ptlst == -1:
+                        raise ValueError("Bad route string: {}".format(row['route']))
+                elif row.get('lat') not in (None,"") and row.get('lng') not in (None,""):
+                    ptlst = [{'lat':float(row['lat']),'lng':float(row['lng'])}]
+                    if row.get('alt') not in (None,""):
+                        ptlst[0]['alt'] = int(round(float(row['alt'])))
+                else:
+                    raise ValueError("Row has no address, lat/lng or route")
+            except Exception as e:
+                self.logger.error("Job row {} not planned: {}".format(rowkey,e))
+                continue
+            for pt in ptlst:
+                yield {'lat':pt['lat'],'lng':pt['lng'],'alt':pt.get('alt'),'rtname':rtname,'row':rowkey}
+
+    def planShards(self,ptiter,sharddir,rtname,precision=None):
+        ''' Partition a stream of points (from getKMLPoints, getDirections, getJobPoints, ...)
+            into shards by the geohash cell of each point, SHARDPRECISION characters long.
+            Each shard's points go to sharddir/<cell>.points.jsonl, tagged with their sequence
+            number in ptiter, and sharddir/manifest.json lists the shards. A shard depends only
+            on the points in its cell, so the same input always gives the same shards. At most
+            MAXSHARDFILES shard files are open at once; the least recently used is closed and
+            reopened for appending when its cell comes up again '''
+        precision = int(precision or self.getSetting("SHARDPRECISION") or 5)
+        os.makedirs(sharddir,exist_ok=True)
+        tmpfn = lambda cell: os.path.join(sharddir,"{}.points.jsonl.tmp".format(cell))
+        shards = {}
+        files = OrderedDict()
+        try:
+            for seq, pt in enumerate(ptiter):
+                cell = geohash(pt['lat'],pt['lng'],precision)
+                if cell in files:
+                    files.move_to_end(cell)
+                else:
+                    if len(files) >= MAXSHARDFILES:
+                        files.popitem(last=False)[1].close()
+                    files[cell] = open(tmpfn(cell),'a' if cell in shards else 'w')
+                    shards.setdefault(cell,{'points':0})
+                rec = {'seq':seq,'lat':pt['lat'],'lng':pt['lng'],'rtname':pt.get('rtname') or rtname}
+                for key in ('alt','row'):
+                    if pt.get(key) is not None:
+                        rec[key] = pt[key]
+                files[cell].write(json.dumps(rec) + "\n")
+                shards[cell]['points'] += 1
+        except BaseException:
+            for f in files.values():
+                f.close()
+            for cell in shards:
+                if os.path.exists(tmpfn(cell)):
+                    os.remove(tmpfn(cell))
+            raise
+        for f in files.values():
+            f.close()
+        for cell in shards:
+            os.replace(tmpfn(cell),tmpfn(cell)[:-len(".tmp")])
+        manifest = {'rtname':rtname,'precision':precision,'points':sum(s['points'] for s in shards.values()),
+                    'shards':{cell:shards[cell] for cell in sorted(shards)}}
+        writeAtomic(os.path.join(sharddir,"manifest.json"),json.dumps(manifest,indent=4).encode())
+        self.logger.info("Planned {} points into {} shards in {}".format(manifest['points'],len(shards),sharddir))
+        return manifest
+
+    def getShardManifest(self,sharddir):
+        with open(os.path.join(sharddir,"manifest.json")) as mfile:
+            return json.load(mfile)
+
+    def runShard(self,sharddir,cell):
+        ''' Worker entry point: run the points of one shard, saving images under IMGDIR/<cell>,
+            and write a status line per point to sharddir/<cell>.results.jsonl. The results
+            file only appears once the shard is complete, so a failed shard can simply be run
+            again on its own '''
+        if cell not in self.getShardManifest(sharddir)['shards']:
+            raise ValueError("No shard {} in {}".format(cell,sharddir))
+        with open(os.path.join(sharddir,"{}.points.jsonl".format(cell))) as pfile:
+            ptlst = [json.loads(line) for line in pfile if line.strip()]
+        imgdir = self.getSetting("IMGDIR")
+        self.setSetting("IMGDIR",os.path.join(imgdir,cell))
+        try:
+            lines = []
+            for rtname, group in itertools.groupby(ptlst,key=lambda pt: pt['rtname']):
+                group = list(group)
+                for pt, result in zip(group,self.runPtLst([dict(pt) for pt in group],rtname)):
+                    status = {key:pt[key] for key in ('seq','lat','lng','rtname','row') if key in pt}
+                    status['shard'] = cell
+                    status['status'] = result.get('status','OK')
+                    status['images'] = result.get('images',[])
+                    if result.get('error'):
+                        status['error'] = result['error']
+                    lines.append(json.dumps(status) + "\n")
+        finally:
+            self.closeOutput()
+            self.setSetting("IMGDIR",imgdir)
+        writeAtomic(os.path.join(sharddir,"{}.results.jsonl".format(cell)),"".join(lines).encode())
+        self.logger.info("Shard {}: {} points done".format(cell,len(lines)))
+        return len(lines)
+
+    def runShards(self,sharddir):
+        ''' Run, one after the other, every shard of sharddir that has no results yet '''
+        for cell in self.getShardManifest(sharddir)['shards']:
+            if not os.path.isfile(os.path.join(sharddir,"{}.results.jsonl".format(cell))):
+                self.runShard(sharddir,cell)
+
+    def mergeShards(self,sharddir,outfile=None):
+        ''' Merge the per-shard results of sharddir into one results file (default 
+            sharddir/results.jsonl) in the original point order, and write a summary of
+            the shards (done, missing) and point statuses to sharddir/merged.json. At most
+            MAXSHARDFILES files are merged at once; more are merged in rounds through
+            temporary files '''
+        outfile = outfile if outfile is not None else os.path.join(sharddir,"results.jsonl")
+        manifest = self.getShardManifest(sharddir)
+        resultfiles = []
+        missing = []
+        for cell in manifest['shards']:
+            fn = os.path.join(sharddir,"{}.results.jsonl".format(cell))
+            if os.path.isfile(fn):
+                resultfiles.append(fn)
+            else:
+                missing.append(cell)
+        counts = {}
+        runs = []
+        try:
+            fnlst = resultfiles
+            while len(fnlst) > MAXSHARDFILES:
+                batches = [fnlst[ii:ii + MAXSHARDFILES] for ii in range(0,len(fnlst),MAXSHARDFILES)]
+                fnlst = []
+                for batch in batches:
+                    runs.append(os.path.join(sharddir,".merge{}.jsonl.tmp".format(len(runs))))
+                    with open(runs[-1],'w') as ofile:
+                        for line in mergeBySeq(batch):
+                            ofile.write(line)
+                    fnlst.append(runs[-1])
+            with open(outfile + ".tmp",'w') as ofile:
+                for line in mergeBySeq(fnlst):
+                    status = json.loads(line)['status']
+                    counts[status] = counts.get(status,0) + 1
+                    ofile.write(line)
+            os.replace(outfile + ".tmp",outfile)
+        finally:
+            for runfn in runs:
+                if os.path.exists(runfn):
+                    os.remove(runfn)
+        summary = {'shards':len(manifest['shards']),'done':len(resultfiles),'missing':missing,
+                   'points':manifest['points'],'status':counts,'results':outfile}
+        writeAtomic(os.path.join(sharddir,"merged.json"),json.dumps(summary,indent=4).encode())
+        if missing:
+            self.logger.error("Merge of {}: {} of {} shards have no results: {}".format(
+                    sharddir,len(missing),len(manifest['shards']),missing))
+        return summary
+
     def getDirections(self,rtestr):
         ''' Start the pipeline with two street addresses and use the Google Maps walking directions
-            to generate the turn points for photo gathering '''
+            to generate the turn points for photo gathering. With SPACING set, the points are
+            instead sampled every SPACING metres along the route's overview polyline '''
         if 'start=' not in rtestr or 'end=' not in rtestr:
             self.logger.error("Bad route string; Missing start or end: %s" % rtestr)
             return -1
         rtelst=rtestr.split(';')
         staddr = rtelst[0].split("=")[1] if 'start=' in rtelst[0] else rtelst[1].split("=")[1]
         dstaddr = rtelst[0].split("=")[1] if 'end=' in rtelst[0] else rtelst[1].split("=")[1]
-        directions_result = self.gmapsclient.directions(staddr,
-                                             dstaddr,
-                                             mode="walking",
-                                         departure_time=datetime.now())
+        self.metrics.incr("api_calls","directions")
+        with self.scheduler.call("directions"), self.metrics.timer("directions"):
+            directions_result = self.getMapsClient().directions(staddr,
+                                                 dstaddr,
+                                                 mode="walking",
+                                             departure_time=datetime.now())
         dr = directions_result[0]
+        if self.getSetting("SPACING") and 'overview_polyline' in dr:
+            return self.getPathPts(googlemaps.convert.decode_polyline(dr['overview_polyline']['points']))
         legs = dr['legs']
         turns = []
         for leg in legs:
@@ -311,141 +1004,547 @@ class GMapView(object):
             turns.append(step['end_location'])
         return turns
 
-    def runKML(self,kmlfile, rtname):
-        ''' Start the pipeline with a kml file -- this is very limited now TODO make more general
-            It only works with kml files with a LinesString feature with name rtname '''
-        with open(kmlfile) as f:
-            geodict = xmltodict.parse(f.read())
-        placelst = geodict['kml']['Document']['Placemark']
-        if not type(placelst) is list:
-            placelst=[placelst]
-
-        for place in placelst:
-            if place['name'] == rtname:
-                coord = place['LineString']['coordinates']
-                coordlst = [c1.split(",") for c1 in coord.split(" ")]
-                coordictlst = [{'lat':float(coord[1]),'lng':float(coord[0]),'alt':int(round(float(coord[2])))} for coord in coordlst]
-        self.runPtLst(coordictlst,rtname)
+    def runKML(self,kmlfile, rtname, namefilter=None):
+        ''' Start the pipeline with a kml or kmz file. Without namefilter only the Placemarks named
+            rtname are used; otherwise namefilter is a regular expression searched for in the
+            Placemark names ('.*' selects every Placemark). Points are read incrementally '''
+        return self.runPtLst(self.getKMLPoints(kmlfile,rtname if namefilter is None else None,namefilter),rtname)
+
+    def getKMLPoints(self,kmlfile,name=None,namefilter=None):
+        ''' Generator over the points of the Point, LineString and LinearRing/Polygon outline
+            geometries of the Placemarks (in any Folder or MultiGeometry) of a kml or kmz file.
+            The file is parsed incrementally and each Placemark is discarded once its points
+            have been yielded, so memory use does not grow with the size of the file '''
+        pattern = re.compile(namefilter) if namefilter is not None else None
+        if zipfile.is_zipfile(kmlfile):
+            with zipfile.ZipFile(kmlfile) as kmz:
+                kmlnames = [fn for fn in kmz.namelist() if fn.lower().endswith(".kml")]
+                if not kmlnames:
+                    self.logger.error("No kml document in {}".format(kmlfile))
+                    return
+                docname = "doc.kml" if "doc.kml" in kmlnames else kmlnames[0]
+                with kmz.open(docname) as f:
+                    for pt in self.iterKMLPoints(f,name,pattern):
+                        yield pt
+        else:
+            with open(kmlfile,'rb') as f:
+                for pt in self.iterKMLPoints(f,name,pattern):
+                    yield pt
+
+    def iterKMLPoints(self,f,name,pattern):
+        nplaces = 0
+        stack = []
+        for event, elem in ElementTree.iterparse(f,events=("start","end")):
+            if event == "start":
+                stack.append(elem)
+                continue
+            stack.pop()
+            tag = kmlTag(elem)
+            if tag == "Placemark":
+                placename = elem.findtext("{*}name") or ""
+                if (name is None or placename == name) and (pattern is None or pattern.search(placename)):
+                    nplaces += 1
+                    for gtag, coordtext in kmlGeometries(elem):
+                        if gtag != "Point" and self.getSetting("SPACING"):
+                            for pt in self.getPathPts(list(kmlCoordinates(coordtext))):
+                                yield pt
+                            continue
+                        for pt in kmlCoordinates(coordtext):
+                            yield pt
+            ''' Drop finished features so the tree never holds more than the current one '''
+            if stack and (tag == "Placemark" or kmlTag(stack[-1]) in ("Document","Folder")):
+                stack[-1].remove(elem)
+        if nplaces == 0:
+            self.logger.warning("No Placemark matched name {} filter {}".format(name,pattern.pattern if pattern else None))
     
     ''' These two functions do the bulk of the real API work '''
-    def getResultsGEO(self,locdict,rtname,randomheading=False):
-        ''' Get links to the right photos for a single point from the google streetview API '''
+    def getResultsGEO(self,locdict,rtname,randomheading=False,**kwargs):
+        ''' Get links to the right photos for a single point from the google streetview API.
+            Headings already in the image cache are not requested again '''
+        with self.metrics.timer("getResultsGEO"):
+            return self.getResultsGEOTimed(locdict,rtname,randomheading)
+
+    def getResultsGEOTimed(self,locdict,rtname,randomheading):
         lat,lng = locdict['lat'],locdict['lng']
         locstr = "%f,%f" % (lat,lng)
         random.seed()
         if randomheading:
             headings = "{}".format(round(random.uniform(0,359)))
+        elif locdict.get('bearing') is not None:
+            headings = ";".join(str(round(locdict['bearing'] + offset) % 360) for offset in self.getRelHeadings())
         else:
             headings =  self.settings['HEADINGS']
-        apiargs = {
-            'size': self.settings['IMGSIZE'], # max 640x640 pixels
-            'location': locstr,
-            'heading': headings,
-            'pitch': str(self.settings['PITCH']),
-            'key': self.GAPIKEY
-        }
+        headinglst = headings.split(";")
+        locdict['covered'] = self.getCoveredHeadings(lat,lng,headinglst)
+        if locdict['covered']:
+            self.logger.debug("Already have headings {} near {}".format(locdict['covered'],locstr))
+            headinglst = [heading for heading in headinglst if heading not in locdict['covered']]
         locdict['locstr'] = locstr
-        ''' Get a list of all possible queries from multiple parameters '''
-        api_list = google_streetview.helpers.api_list(apiargs)
-    
-        # Create a results object for all possible queries
-        results = google_streetview.api.results(api_list)
+        locdict['headings'] = headinglst
+        locdict['cachekeys'] = {heading:self.getCacheKey(locdict,heading) for heading in headinglst} \
+                if self.imagecache is not None else {}
+        ''' Headings dropped by the content filter on an earlier run are not downloaded again '''
+        locdict['dropped'] = {heading:note for heading, note in
+                              ((heading,self.imagecache.getNote(key)) for heading, key in locdict['cachekeys'].items())
+                              if note is not None} if self.hashindex is not None else {}
+        locdict['cached'] = [heading for heading in headinglst if heading not in locdict['dropped']
+                             and heading in locdict['cachekeys'] and self.imagecache.contains(locdict['cachekeys'][heading])]
+        fetchlst = [heading for heading in headinglst if heading not in locdict['cached'] and heading not in locdict['dropped']]
+        locdict['fetched'] = fetchlst
+        results = None
+        if fetchlst:
+            ''' One metadata lookup per point tells us whether there is imagery at all '''
+            if 'pano_id' in locdict:
+                locdict['metadata'] = {'status':'OK','pano_id':locdict['pano_id']}
+            else:
+                locdict['metadata'] = self.getPanoMetadata(locdict)
+            if locdict['metadata'].get('status') == 'OK':
+                apiargs = {
+                    'size': self.settings['IMGSIZE'], # max 640x640 pixels
+                    'location': locstr,
+                    'pitch': str(self.settings['PITCH']),
+                    'key': self.GAPIKEY
+                }
+                if 'pano_id' in locdict:
+                    del apiargs['location']
+                    apiargs['pano'] = locdict['pano_id']
+                results = [dict(apiargs,heading=heading) for heading in fetchlst]
+            else:
+                self.logger.warning("No imagery at {}: {}".format(locstr,locdict['metadata'].get('status')))
         locdict['results'] = results
+        locdict['route'] = rtname
         locdict['rtname'] = rtname + "latx%3.5flngx%3.5f" % (locdict['lat'],locdict['lng'])
         return locdict
+
+    def getRelHeadings(self):
+        ''' RELHEADINGS as offsets in degrees from the direction of travel '''
+        offsets = []
+        for rel in re.split("[,;]",str(self.getSetting("RELHEADINGS") or "forward,backward")):
+            rel = rel.strip().lower()
+            if rel:
+                offsets.append(RELHEADINGS[rel] if rel in RELHEADINGS else float(rel))
+        return offsets
+
+    def addBearings(self,ptiter,chunk=1024):
+        ''' Generator over copies of the points with their 'bearing', the direction of travel
+            in degrees. Bearings are computed with pathBearings over chunks of the route, each
+            with its neighbouring points, so a long route is never held in memory at once '''
+        prev = None
+        buf = []
+        for pt in ptiter:
+            buf.append(pt)
+            if len(buf) <= chunk:
+                continue
+            for bpt in self.bearingChunk(prev,buf[:-1],buf[-1]):
+                yield bpt
+            prev = buf[-2]
+            buf = buf[-1:]
+        for bpt in self.bearingChunk(prev,buf,None):
+            yield bpt
+
+    def bearingChunk(self,prev,buf,nxt):
+        if not buf:
+            return []
+        ctx = ([prev] if prev is not None else []) + buf + ([nxt] if nxt is not None else [])
+        bearings = pathBearings(np.array([pt['lat'] for pt in ctx],dtype=float),
+                                np.array([pt['lng'] for pt in ctx],dtype=float))
+        if prev is not None:
+            bearings = bearings[1:]
+        return [dict(pt,bearing=None if np.isnan(bearing) else float(bearing))
+                for pt, bearing in zip(buf,bearings.tolist())]
+
+    def getCoveredHeadings(self,lat,lng,headinglst):
+        ''' The headings that already have an indexed image within COVERRADIUS metres '''
+        radius = float(self.getSetting("COVERRADIUS") or 0)
+        if self.spatialindex is None or radius <= 0:
+            return []
+        with self.metrics.timer("index"):
+            have = set(round(res['heading']) % 360 for res in self.spatialindex.query(lat,lng,radius,headinglst))
+        return [heading for heading in headinglst if round(float(heading)) % 360 in have]
+
+    def queryImages(self,lat,lng,radius_m,headings=None):
+        ''' Images already saved within radius_m metres of lat,lng, nearest first, optionally
+            only those at the given headings. Each is a dict with lat, lng, heading, pitch,
+            pano_id, route, path (file or tar reference), time and distance '''
+        if self.spatialindex is None:
+            self.logger.error("No spatial index; set INDEXFILE")
+            return []
+        return self.spatialindex.query(float(lat),float(lng),float(radius_m),headings)
+
+    def getCacheKey(self,loc,heading):
+        ''' Normalize the request parameters for one image into an image cache key '''
+        precision = int(self.getSetting("CACHEPRECISION") or 5)
+        if 'pano_id' in loc:
+            return ImageCache.makeKey(pano=loc['pano_id'],
+                                      heading=str(heading),
+                                      pitch=str(self.settings['PITCH']),
+                                      size=self.settings['IMGSIZE'])
+        return ImageCache.makeKey(lat=round(float(loc['lat']),precision),
+                                  lng=round(float(loc['lng']),precision),
+                                  heading=str(heading),
+                                  pitch=str(self.settings['PITCH']),
+                                  size=self.settings['IMGSIZE'])
+
+    def getCacheStats(self):
+        return self.imagecache.stats() if self.imagecache is not None else None
     
-    def saveResults(self,loc,**kwargs):
-        ''' Use the links from above to download the images; rename and tag them '''
+    def saveResults(self,loc,show=True,**kwargs):
+        ''' Download the images for a point and tag them. Each image is fetched into memory,
+            the GPS EXIF segment is spliced in without decoding the pixels and the file is
+            written once under its final (unique) name with an atomic rename. Cached headings
+            are linked (or copied) from the image cache instead of downloaded '''
+        with self.metrics.timer("saveResults"):
+            self.saveResultsTimed(loc)
+        if show:
+            self.showResults(loc)
+        return loc
+
+    def saveResultsTimed(self,loc):
         timestamp = humandate(time.time())[:-7]
-        loc['results'].download_links(self.settings["IMGDIR"])
-        numf = len(loc['results'].links)
-        GSVHEADER='GSV_' + loc['rtname'] + \
-                "_p" + str(self.settings['PITCH']) + "_" + timestamp + "_"        
-        headinglst = self.settings['HEADINGS'].split(";")
+        os.makedirs(self.settings["IMGDIR"],exist_ok=True)
+        GSVHEADER='GSV_' + loc['rtname'] + "_h{}" + \
+                "_p" + str(self.settings['PITCH']) + "_" + timestamp + "_" + uuid.uuid4().hex[:8] + "_{}.jpg"        
+        exifbytes = gpsExif(float(loc['lat']),float(loc['lng']),loc.get('alt',0))
+        tarwriter = self.getTarWriter() if self.getSetting("OUTPUTMODE") == "tar" else None
+        derivatives = self.getDerivatives() if self.getSetting("DERIVATIVES") else None
+        derivdir = self.getSetting("DERIVDIR") or os.path.join(self.settings["IMGDIR"],"derived")
+        panoid = loc.get('pano_id') or (loc.get('metadata') or {}).get('pano_id')
         imnamelst = []
         nfnlst = []
-        for fct in range(0,numf):
+        indexlst = []
+        for fct,heading in enumerate(loc['headings']):
             ''' Give the file a unique name '''
-            try:
-                fn = loc['results'].metadata[fct]['_file']
-            except:
-                self.logger.error("Filename not found -- skip point")
+            newfn = os.path.join(self.settings["IMGDIR"],GSVHEADER.format(heading,fct))
+            meta = {'lat':loc['lat'],'lng':loc['lng'],'alt':loc.get('alt'),'heading':heading,
+                    'pitch':self.settings['PITCH'],'pano_id':panoid,'rtname':loc.get('route',loc['rtname'])}
+            if heading in loc['dropped']:
+                if self.replayDropped(loc,heading,newfn,tarwriter is None) == 'linked':
+                    nfnlst.append(newfn)
+                    imnamelst.append(newfn)
+                    indexlst.append(dict(meta,path=newfn))
                 continue
-            ffn = os.path.join(self.settings["IMGDIR"],fn)
-            newfn = os.path.join(self.settings["IMGDIR"],GSVHEADER+fn).replace("gsv_","").replace("_p","_h%s_p" % headinglst[fct])
-            nfnlst.append(newfn)
-            self.logger.debug("%s to %s" % (fn,newfn))
-            if not os.path.isfile(ffn):
-                self.logger.error(ffn," does not exist")
+            if heading in loc['cached']:
+                with self.metrics.timer("cache"):
+                    if tarwriter is None:
+                        cachehit = self.imagecache.materialize(loc['cachekeys'][heading],newfn)
+                        if cachehit and derivatives is not None:
+                            data = self.imagecache.read(loc['cachekeys'][heading])
+                            if data is not None:
+                                derivatives.submit(data,exifbytes,derivdir,os.path.basename(newfn))
+                    else:
+                        data = self.imagecache.read(loc['cachekeys'][heading])
+                        cachehit = data is not None
+                        if cachehit:
+                            imref = tarwriter.add(os.path.basename(newfn),data,meta)
+                            if derivatives is not None:
+                                derivatives.submit(data,exifbytes,derivdir,os.path.basename(newfn))
+                if cachehit:
+                    self.logger.debug("cache hit for heading {} to {}".format(heading,newfn))
+                    self.metrics.incr("images_cached")
+                    if tarwriter is None:
+                        nfnlst.append(newfn)
+                    imnamelst.append(newfn if tarwriter is None else imref)
+                    indexlst.append(dict(meta,path=imnamelst[-1]))
+                else:
+                    self.logger.error("Cache entry for {} heading {} vanished -- skip image".format(loc['locstr'],heading))
+                    self.metrics.incr("images_skipped")
                 continue
-            os.rename(ffn,newfn)
-        
-            ''' Add metadata '''
-            loctup = (float(loc['lat']),float(loc['lng']))
-            photo = gpsphoto.GPSPhoto(newfn)
-            if 'alt' in loc:
-                altv = loc['alt']
+            if loc['results'] is None:
+                self.metrics.incr("images_skipped")
+                continue
+            params = loc['results'][loc['fetched'].index(heading)]
+            with self.metrics.timer("download"):
+                r = self.httpGet(self.getApiUrl("/maps/api/streetview"), params=params)
+            if r.status_code != 200 or r.content[:2] != b"\xff\xd8":
+                self.logger.error("Image for {} heading {} not downloaded (HTTP {})".format(loc['locstr'],heading,r.status_code))
+                self.metrics.incr("images_skipped")
+                continue
+            if self.hashindex is not None:
+                with self.metrics.timer("hash"):
+                    dropped = self.filterImage(loc,heading,r.content,newfn,tarwriter is None)
+                if dropped == 'linked':
+                    nfnlst.append(newfn)
+                    imnamelst.append(newfn)
+                    indexlst.append(dict(meta,path=newfn))
+                if dropped:
+                    continue
+            ''' Add metadata and write the file, or append it to the current tar shard '''
+            with self.metrics.timer("write"):
+                data = insertExif(exifbytes,r.content)
+                if tarwriter is None:
+                    writeAtomic(newfn,data)
+                    if heading in loc['cachekeys']:
+                        self.imagecache.put(loc['cachekeys'][heading],newfn)
+                else:
+                    imref = tarwriter.add(os.path.basename(newfn),data,meta)
+                    if heading in loc['cachekeys']:
+                        self.imagecache.putData(loc['cachekeys'][heading],data)
+            if derivatives is not None:
+                with self.metrics.timer("derivatives_wait"):
+                    derivatives.submit(data,exifbytes,derivdir,os.path.basename(newfn))
+            self.metrics.incr("images_written")
+            if tarwriter is None:
+                self.logger.debug("heading {} to {}".format(heading,newfn))
+                nfnlst.append(newfn)
+                imnamelst.append(newfn)
             else:
-                altv = 0
-            info = gpsphoto.GPSInfo((loctup),alt=altv)
-            photo.modGPSData(info, newfn)
-            imnamelst.append(newfn)
-            
-        ''' Display the images '''
+                self.logger.debug("heading {} to {}".format(heading,imref))
+                imnamelst.append(imref)
+            indexlst.append(dict(meta,path=imnamelst[-1]))
+        if self.spatialindex is not None and indexlst and not self.settings['CLEAN']:
+            with self.metrics.timer("index"):
+                self.spatialindex.add(indexlst)
+        loc['images'] = imnamelst
+        loc['files'] = nfnlst
+        return loc
+
+    def filterImage(self,loc,heading,jpeg,newfn,linkable):
+        ''' Content filter for a downloaded image: returns 'placeholder' for the grey "no
+            imagery" frame, 'duplicate' for a frame within DEDUPDISTANCE bits of the perceptual
+            hash of one already kept, 'linked' if such a duplicate was hardlinked to newfn
+            instead (DEDUPMODE 'link', loose files only), or None to keep the image. The verdict
+            is noted in the image cache so that later runs do not download the image again '''
+        imhash, std = imageHash(jpeg)
+        if std < float(self.getSetting("PLACEHOLDERSTD") or 0) or \
+                any(hamming(imhash,int(phash,16)) <= self.hashindex.distance for phash in self.placeholders):
+            self.logger.warning("Placeholder image for {} heading {} dropped (hash {:016x})".format(
+                    loc['locstr'],heading,imhash))
+            self.metrics.incr("images_dropped","placeholder")
+            self.noteDropped(loc,heading,'placeholder')
+            return 'placeholder'
+        match = self.hashindex.match(imhash,newfn)
+        if match is None:
+            return None
+        self.logger.debug("Image for {} heading {} duplicates {}".format(loc['locstr'],heading,match))
+        self.metrics.incr("images_dropped","duplicate")
+        self.noteDropped(loc,heading,'duplicate:' + match)
+        if linkable and self.getSetting("DEDUPMODE") == "link":
+            try:
+                linkOrCopy(match,newfn)
+                return 'linked'
+            except OSError as e:
+                self.logger.debug("Could not link {}: {}".format(match,e))
+        return 'duplicate'
+
+    def noteDropped(self,loc,heading,note):
+        if heading in loc['cachekeys']:
+            self.imagecache.putNote(loc['cachekeys'][heading],note)
+
+    def replayDropped(self,loc,heading,newfn,linkable):
+        ''' Repeat the filterImage verdict noted in the image cache for a heading, without
+            downloading it: a duplicate is linked to the image it matched if that still exists '''
+        verdict, _, match = loc['dropped'][heading].partition(":")
+        self.logger.debug("Image for {} heading {} was dropped before ({})".format(loc['locstr'],heading,verdict))
+        self.metrics.incr("images_dropped",verdict)
+        if verdict == 'duplicate' and linkable and self.getSetting("DEDUPMODE") == "link" and os.path.isfile(match):
+            try:
+                linkOrCopy(match,newfn)
+                return 'linked'
+            except OSError as e:
+                self.logger.debug("Could not link {}: {}".format(match,e))
+        return verdict
+
+    def getTarWriter(self):
+        ''' The tar shard writer for OUTPUTMODE 'tar', started on first use and restarted
+            if IMGDIR changes (as it does between the shards of a sharded run) '''
+        with self.tarlock:
+            if self.tarwriter is not None and self.tarwriter.outdir != self.settings['IMGDIR']:
+                self.tarwriter.close()
+                self.tarwriter = None
+            if self.tarwriter is None:
+                self.tarwriter = TarShardWriter(self.settings['IMGDIR'],
+                        int(self.getSetting("TARSIZE") or 1024)*1024*1024,logger=self.logger)
+                atexit.register(self.tarwriter.close)
+        return self.tarwriter
+
+    def getDerivatives(self):
+        ''' The derivative process pool for DERIVATIVES, started on first use '''
+        with self.tarlock:
+            if self.derivatives is None:
+                self.derivatives = DerivativeWriter(self.getSetting("DERIVATIVES"),
+                        workers=int(self.getSetting("DERIVWORKERS") or 0),
+                        maxpending=int(self.getSetting("DERIVQUEUE") or 0),logger=self.logger,metrics=self.metrics)
+                atexit.register(self.derivatives.close)
+        return self.derivatives
+
+    def closeOutput(self):
+        ''' Finish the current tar shard, if any, so that it and its index are complete, and
+            wait for the derivatives of the images saved so far '''
+        with self.tarlock:
+            if self.tarwriter is not None:
+                self.tarwriter.close()
+                self.tarwriter = None
+            derivatives = self.derivatives
+        if derivatives is not None:
+            derivatives.flush()
+
+    def showResults(self,loc):
+        ''' Display the images saved for a point and clean them up if requested. With PLOTMODE
+            'sheet' or 'routesheet' the images are rendered into PNG contact sheets by a
+            background worker instead, so the pipeline does not wait for them '''
+        if loc.get('status') == 'ERROR' or self.getSetting("OUTPUTMODE") == "tar":
+            return loc
+        nfnlst = list(loc['files'])
+        if self.settings['PLOTON'] and self.getSetting("PLOTMODE") in ("sheet","routesheet"):
+            mapfetch = None
+            if self.settings['MAPON'] and self.getSetting("MAPMODE") != "route":
+                cntr = "{0},{1}".format(float(loc['lat']),float(loc['lng']))
+                mapfn = os.path.join(self.settings['IMGDIR'],".map_{}.png".format(uuid.uuid4().hex))
+                mapfetch = self.bindSettings(lambda: self.getMap(cntr,output_file=mapfn))
+            with self.sheetlock:
+                ''' Held so that the writer is not restarted between getting it and adding to it '''
+                self.getContactSheets().addPoint(loc['rtname'],"{} at {}".format(loc['rtname'],loc['locstr']),
+                        list(loc['images']),mapfetch=mapfetch,cleanup=nfnlst if self.settings['CLEAN'] else [],
+                        route=loc.get('route'),perpoint=self.getSetting("PLOTMODE") == "sheet")
+            return loc
         if self.settings['PLOTON']:
             imlst = []
-            for im in imnamelst:
+            for im in loc['images']:
                 imlst.append(Image.open(im))
             ''' Get the Map '''
-            if self.settings['MAPON']:
-                cntr = "{0},{1}".format(loctup[0],loctup[1])
+            if self.settings['MAPON'] and self.getSetting("MAPMODE") != "route":
+                cntr = "{0},{1}".format(float(loc['lat']),float(loc['lng']))
                 mapim = self.getMap(cntr)
-                nfnlst.append('{}/tmpmap.png'.format(self.settings['IMGDIR']))
-                imlst.append(mapim)
+                if mapim is not None:
+                    imlst.append(mapim)
             title = "{} at {}".format(loc['rtname'],loc['locstr']) \
                     if 'TITLE' not in self.settings else self.settings['TITLE']
             self.plotImages(imlst,xpos=self.settings['XPOS'],ypos=self.settings['YPOS'],title=title)
+            if self.settings['MAPON'] and self.getSetting("MAPMODE") != "route" and mapim is not None \
+                    and os.path.isfile(mapim.filename):
+                os.remove(mapim.filename)
             
         if self.settings['CLEAN']:
             self.logger.debug("Deleting downloaded files: {}".format(nfnlst))
             for fn in nfnlst:
                 if os.path.isfile(fn):
                     os.remove(fn)
+        return loc
+
+    def getContactSheets(self):
+        ''' The background contact sheet writer, started on first use and restarted if the
+            sheet directory changes (as IMGDIR does between the shards of a sharded run) '''
+        with self.sheetlock:
+            sheetdir = self.getSetting("SHEETDIR") or os.path.join(self.settings['IMGDIR'],"sheets")
+            if self.contactsheets is not None and self.contactsheets.sheetdir != sheetdir:
+                self.contactsheets.close()
+                self.contactsheets = None
+            if self.contactsheets is None:
+                thumbsize = tuple(self.getSetting("THUMBSIZE") or (240,120))
+                self.contactsheets = ContactSheetWriter(sheetdir,thumbsize=thumbsize,
+                        pagesize=int(self.getSetting("SHEETPAGE") or 64),logger=self.logger,metrics=self.metrics)
+                atexit.register(self.contactsheets.close)
+        return self.contactsheets
+
+    def endRouteSheets(self,rtname):
+        with self.sheetlock:
+            if self.contactsheets is not None:
+                self.contactsheets.endRoute(rtname)
     
     def getMap(self,center, zoom=15, size ='640x640', 
                sensor ='false', mtype='roadmap',
                marker_list = [], marker_color='blue', marker_tag='W',
                output_file=None, PLOTON=False,
                **kwargs):
-        url = "https://maps.googleapis.com/maps/api/staticmap?"
-        output_file = output_file if output_file is not None else '{}/tmpmap.png'.format(self.settings['IMGDIR'])
-        apikey = self.GAPIKEY
-        urlstr = "{0}center={1}&zoom={2}&size={3}&sensor={5}&type={6}&markers=color:red%7Clabel:C%7C{7}&key={4}" \
-                .format(url,center,zoom,size,apikey,sensor,mtype,center)
+        output_file = output_file if output_file is not None else \
+                os.path.join(self.settings['IMGDIR'],"MAP_{}_{}.png".format(center,uuid.uuid4().hex[:8]))
+        with self.metrics.timer("getMap"):
+            return self.getMapTimed(center,zoom,size,sensor,mtype,marker_list,marker_color,marker_tag,output_file,PLOTON)
+
+    def getMapTimed(self,center,zoom,size,sensor,mtype,marker_list,marker_color,marker_tag,output_file,PLOTON):
+        urlstr = "{0}?center={1}&zoom={2}&size={3}&sensor={4}&type={5}&markers=color:red%7Clabel:C%7C{6}" \
+                .format(self.getApiUrl("/maps/api/staticmap"),center,zoom,size,sensor,mtype,center)
         for marker in marker_list:
             urlstr = "{0}&markers=color:{1}%7Clabel:{2}%7C{3}".format(urlstr,marker_color,marker_tag,marker)
-        self.logger.debug(urlstr)
-        r = requests.get(urlstr)
-        with open(output_file, 'wb') as f:
-            f.write(r.content)
-        retim = Image.open(output_file)
-        if PLOTON:
+        retim = self.fetchStaticMap(urlstr,output_file)
+        if PLOTON and retim is not None:
             self.plotImages([retim])
         return retim
+
+    def getRouteMap(self,ptlst,rtname,size='640x640',mtype='roadmap',marker_color='blue'):
+        ''' Overview maps of a route with every point as a marker; the map is auto-fitted to the
+            markers. Points are split over as many maps as needed to keep each URL under
+            MAXURLLEN characters. Returns the list of map images '''
+        baseurl = "{0}?size={1}&type={2}&markers=size:tiny%7Ccolor:{3}".format(self.getApiUrl("/maps/api/staticmap"),size,mtype,marker_color)
+        maxlen = MAXURLLEN - len("&key=") - len(self.GAPIKEY)
+        chunks = [baseurl]
+        npts = 0
+        for pt in ptlst:
+            npts += 1
+            marker = "%7C{:.5f},{:.5f}".format(float(pt['lat']),float(pt['lng']))
+            if len(chunks[-1]) + len(marker) > maxlen:
+                chunks.append(baseurl)
+            chunks[-1] += marker
+        maplst = []
+        for ii, urlstr in enumerate(chunks):
+            if urlstr == baseurl:
+                continue
+            output_file = os.path.join(self.settings['IMGDIR'],"ROUTEMAP_{}_{:04d}.png".format(rtname,ii))
+            mapim = self.fetchStaticMap(urlstr,output_file)
+            if mapim is not None:
+                maplst.append(mapim)
+        self.logger.info("Route {}: {} points on {} overview maps".format(rtname,npts,len(maplst)))
+        return maplst
+
+    def fetchStaticMap(self,urlstr,output_file):
+        ''' Fetch a Static Maps url (without the key) into output_file, through the map cache.
+            Returns None if the quota scheduler skipped the map or no map image came back '''
+        key = ImageCache.makeKey(url=urlstr)
+        os.makedirs(os.path.dirname(output_file) or ".",exist_ok=True)
+        if self.mapcache is not None and self.mapcache.contains(key) and self.mapcache.materialize(key,output_file):
+            self.logger.debug("map cache hit for {}".format(output_file))
+            return Image.open(output_file)
+        self.logger.debug(urlstr)
+        try:
+            r = self.httpGet("{}&key={}".format(urlstr,self.GAPIKEY))
+        except (QuotaExceeded,requests.exceptions.RequestException) as e:
+            self.logger.warning("Skipping map: {}".format(e))
+            return None
+        try:
+            if r.status_code != 200:
+                raise IOError("HTTP {}".format(r.status_code))
+            Image.open(io.BytesIO(r.content))
+        except IOError as e:
+            self.logger.warning("Skipping map {}: {}".format(os.path.basename(output_file),e))
+            return None
+        writeAtomic(output_file,r.content)
+        if self.mapcache is not None:
+            self.mapcache.put(key,output_file)
+        return Image.open(output_file)
+
+    def showRouteMap(self,pathresult,rtname):
+        ''' With MAPMODE 'route', one overview map replaces the per-point maps '''
+        if not (self.settings['PLOTON'] and self.settings['MAPON'] and self.getSetting("MAPMODE") == "route"):
+            return
+        maplst = self.getRouteMap((res for res in pathresult if res['status'] == 'OK'),rtname)
+        if not maplst:
+            return
+        if self.getSetting("PLOTMODE") in ("sheet","routesheet"):
+            return
+        for mapim in maplst:
+            self.plotImages([mapim],xpos=self.settings['XPOS'],ypos=self.settings['YPOS'],title=rtname)
         
     def plotImages(self,imlst,xpos=100,ypos=100,pause=None,title="TEST2",**kwargs):   
+        with self.metrics.timer("plotImages"):
+            self.plotImagesTimed(imlst,xpos,ypos,pause,title)
+
+    def plotImagesTimed(self,imlst,xpos,ypos,pause,title):
         pause = pause if pause is not None else self.settings['SHOWTIME'] if 'SHOWTIME' in self.settings else 1 
         numim = len(imlst)
         ncols = 2 if numim <= 8 else 4
         nrows = int(ceil(numim/ncols))
         fig = plt.figure(figsize=(self.settings['FIGWIDTH'],self.settings['FIGHEIGHT']))
         fig.suptitle(title)
-        grid = ImageGrid(fig, 111,  # similar to subplot(111)
+        grid = axes_grid1.ImageGrid(fig, 111,  # similar to subplot(111)
             nrows_ncols=(nrows, ncols),
             axes_pad=0.1,  # pad between axes in inch.
         )
         mngr = plt.get_current_fig_manager()
-        mngr.window.move(xpos,ypos)
+        try:
+            mngr.window.move(xpos,ypos)
+        except AttributeError:
+            ''' Non-GUI backends (e.g. Agg) have no window to move '''
+            pass
 
         for ax, im in zip(grid, imlst):
             ax.imshow(im)
@@ -458,40 +1557,128 @@ class GMapView(object):
 
     ''' Some utility functions for generating points on a line '''
     def getPtList(self,pt1,pt2,numpts):
-        ''' creates a list of numpts new points on straight line between pt1 and pt2 '''
-        nn = numpts + 1
-        ptlst = [pt1]
-        m, b,xdist = self.getLine(pt1,pt2)
-        xint = xdist/nn
-        pttuplst = [(ii*xint + pt1['lat'], self.getY((ii*xint + pt1['lat']),m,b)) for ii in range(1,nn)]
-        ptlst = ptlst + [{'lat':pttup[0],'lng':pttup[1]} for pttup in pttuplst]
-        
+        ''' creates a list of numpts new points on the great circle between pt1 and pt2 '''
+        frac = np.arange(1,numpts+1)/(numpts+1)
+        lat, lng = slerpLatLng(np.array([pt1['lat']]),np.array([pt1['lng']]),
+                               np.array([pt2['lat']]),np.array([pt2['lng']]),frac)
+        ptlst = [pt1] + [{'lat':float(lat[ii]),'lng':float(lng[ii])} for ii in range(numpts)]
         ptlst.append(pt2)
         return ptlst
+
+    def getPathPts(self,ptlst,spacing=None):
+        ''' Sample a polyline of points every spacing (default SPACING) metres along its
+            great-circle segments; the first and last points are always included '''
+        spacing = spacing if spacing is not None else self.getSetting("SPACING")
+        if len(ptlst) < 2 or not spacing:
+            return list(ptlst)
+        lat = np.array([pt['lat'] for pt in ptlst],dtype=float)
+        lng = np.array([pt['lng'] for pt in ptlst],dtype=float)
+        alt = np.array([pt['alt'] for pt in ptlst],dtype=float) if all('alt' in pt for pt in ptlst) else None
+        dlat, dlng, dalt = densifyPath(lat,lng,float(spacing),alt)
+        if dalt is None:
+            return [{'lat':plat,'lng':plng} for plat, plng in zip(dlat.tolist(),dlng.tolist())]
+        return [{'lat':plat,'lng':plng,'alt':int(round(palt))} 
+                for plat, plng, palt in zip(dlat.tolist(),dlng.tolist(),dalt.tolist())]
     
-    def getLine(self,pt1,pt2):
-        ''' Pt =  {'lat': x, 'lng': y} '''
-        ''' returns m=slope, b = y-intercept xdist = distance between x2 and x1 '''
-        x1 = pt1['lat']
-        y1 = pt1['lng']
-        x2 = pt2['lat']
-        y2 = pt2['lng']
-        b = (x1*y2 - x2*y1)/(x1-x2)
-        m =  (y1-y2)/(x1-x2)
-        xdist = x2 - x1
-        return m,b,xdist
-    
-    def getY(self,x,m,b):
-        return x*m + b
+    ''' Instrumentation '''
+    def dumpMetrics(self):
+        ''' Write the metrics to METRICSFILE (JSON) and PROMFILE (Prometheus textfile) if set '''
+        if self.getSetting("METRICSFILE"):
+            self.metrics.writeJSON(self.settings["METRICSFILE"])
+        if self.getSetting("PROMFILE"):
+            self.metrics.writePrometheus(self.settings["PROMFILE"])
+
+    ''' Shared HTTP session for all Google endpoints '''
+    def configureHttp(self):
+        self.session = requests.Session()
+        self.httplock = threading.Lock()
+        self.httpstats = {'requests':0,'retries':0,'failures':0}
+        self.mountHttpAdapters()
+
+    def mountHttpAdapters(self):
+        ''' Keep-alive pool large enough for every worker to hold a connection '''
+        poolsize = max(int(self.getSetting("CONCURRENCY") or 1),10)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4,pool_maxsize=poolsize)
+        self.session.mount("https://",adapter)
+        self.session.mount("http://",adapter)
+
+    def getMapsClient(self):
+        ''' The googlemaps client (geocoding and directions), created on first use '''
+        with self.httplock:
+            if self.gmapsclient is None:
+                connect_timeout, read_timeout = self.getHttpTimeout()
+                self.gmapsclient = googlemaps.Client(key=self.GAPIKEY,connect_timeout=connect_timeout,
+                                                     read_timeout=read_timeout,requests_session=self.session,
+                                                     base_url=self.getApiUrl(""))
+        return self.gmapsclient
+
+    def getApiUrl(self,path):
+        ''' URL of a Google Maps endpoint; APIBASE points all of them at another server '''
+        return (self.getSetting("APIBASE") or APIBASE).rstrip("/") + path
+
+    def getHttpTimeout(self):
+        timeout = self.getSetting("HTTPTIMEOUT") or [5,30]
+        return (float(timeout[0]),float(timeout[1])) if isinstance(timeout,(list,tuple)) else (float(timeout),float(timeout))
+
+    def httpGet(self,url,params=None):
+        ''' GET through the quota scheduler and the shared session with connect/read timeouts.
+            Connection errors, timeouts and 429/5xx responses are retried up to HTTPRETRIES times
+            with exponential backoff (HTTPBACKOFF seconds doubled per attempt) and full jitter '''
+        retries = int(self.getSetting("HTTPRETRIES") if self.getSetting("HTTPRETRIES") is not None else 4)
+        backoff = float(self.getSetting("HTTPBACKOFF") or 0.5)
+        timeout = self.getHttpTimeout()
+        endpoint = url.split("?")[0].rsplit("/maps/api/",1)[-1]
+        for attempt in range(retries + 1):
+            try:
+                with self.scheduler.call(endpoint) as call:
+                    with self.httplock:
+                        self.httpstats['requests'] += 1
+                    self.metrics.incr("api_calls",endpoint)
+                    r = self.session.get(url,params=params,timeout=timeout)
+                    call['spent'] = r.status_code == 200
+                if r.status_code not in RETRYSTATUS:
+                    self.metrics.incr("bytes_downloaded",endpoint,len(r.content))
+                    return r
+                reason = "HTTP {}".format(r.status_code)
+            except (requests.exceptions.ConnectionError,requests.exceptions.Timeout) as e:
+                r = None
+                reason = "{}: {}".format(type(e).__name__,self.maskKey(str(e)))
+            if attempt == retries:
+                break
+            with self.httplock:
+                self.httpstats['retries'] += 1
+            delay = random.uniform(0,backoff*(2**attempt))
+            self.logger.debug("Retrying {} in {:.2f}s after {}".format(url.split("?")[0],delay,reason))
+            time.sleep(delay)
+        with self.httplock:
+            self.httpstats['failures'] += 1
+        self.logger.error("Giving up on {} after {} attempts: {}".format(url.split("?")[0],retries + 1,reason))
+        if r is None:
+            raise requests.exceptions.ConnectionError(reason)
+        return r
+
+    def maskKey(self,text):
+        ''' Hide the API key in text that may quote a request URL (e.g. a requests error) '''
+        text = re.sub(r"([?&]key=)[^&\s'\"]+",r"\1<GAPIKEY>",text)
+        return text.replace(self.GAPIKEY,"<GAPIKEY>") if self.GAPIKEY else text
+
+    def getHttpStats(self):
+        with self.httplock:
+            return dict(self.httpstats)
     
     ''' Change the Log Level '''
     def configureLogging(self):
     #     self.logger.basicConfig(format="%(asctime)s [%(levelname)s] %(message)s")
+        ''' Handlers are only added once per process, however many GMapViews are created '''
         self.logger = logging.getLogger(LOGNAME)
         self.logger.propagate = False
+        if any(handler.get_name() in (LOGNAME + "-file",LOGNAME + "-stream") for handler in self.logger.handlers):
+            return self.logger
         fh = logging.FileHandler(LOGNAME+'.log')
+        fh.set_name(LOGNAME + "-file")
         fh.setLevel(logging.INFO)
         ch = logging.StreamHandler(sys.stdout)
+        ch.set_name(LOGNAME + "-stream")
         ch.setLevel(logging.INFO)
         formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
         fh.setFormatter(formatter)
@@ -518,7 +1705,1185 @@ class GMapView(object):
         for handler in self.logger.handlers:
             handler.setLevel(newlevel)
 
+class GMapService(object):
+    ''' Serves runAddress, runPt, runPt2Pt, runDirections and runKML from one warm GMapView
+        over a local JSON API, on host:port or a Unix socket (unix:/path). Requests wait in
+        a queue of at most SERVICEQUEUE (beyond that they get HTTP 503) for one of
+        SERVICEWORKERS threads, and each runs with its own request settings '''
+    METHODS = ('runAddress','runPt','runPt2Pt','runDirections','runKML')
+    ''' Settings used to build the shared clients, caches, indexes and writers; fixed for the service '''
+    FIXED = ('GAPIKEY','ADDRESSFILE','LOGLEVEL','CACHEDIR','CACHESIZE','MAPCACHEDIR','MAPCACHESIZE',
+             'INDEXFILE','USAGEFILE','QPS','COSTS','RUNBUDGET','DAYBUDGET','BUDGETRESERVE','LOWPRIORITY',
+             'DEDUP','DEDUPDISTANCE','DEDUPFILE','PLACEHOLDERHASHES','METRICSFILE','PROMFILE',
+             'DERIVATIVES','DERIVWORKERS','DERIVQUEUE','OUTPUTMODE','TARSIZE','SHEETDIR','THUMBSIZE','SHEETPAGE',
+             'APIBASE','HTTPTIMEOUT','HTTPRETRIES','HTTPBACKOFF','CONCURRENCY')
+
+    def __init__(self,gmsv,address):
+        self.gmsv = gmsv
+        self.logger = gmsv.logger
+        self.address = address
+        self.queue = queue.Queue(maxsize=int(gmsv.getSetting("SERVICEQUEUE") or 64))
+        self.workers = [threading.Thread(target=self.work,name="service{}".format(ii),daemon=True)
+                        for ii in range(int(gmsv.getSetting("SERVICEWORKERS") or 4))]
+        if address.startswith("unix:"):
+            path = address[len("unix:"):]
+            if os.path.exists(path):
+                os.remove(path)
+            self.server = UnixHTTPServer(path,GMapServiceHandler)
+        else:
+            host, _, port = address.rpartition(":")
+            self.server = ThreadingHTTPServer((host or "127.0.0.1",int(port)),GMapServiceHandler)
+        self.server.daemon_threads = True
+        self.server.service = self
+
+    def serve(self):
+        for worker in self.workers:
+            worker.start()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM,self.stop)
+        self.logger.info("Serving on {} with {} workers".format(self.address,len(self.workers)))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.server_close()
+            for worker in self.workers:
+                self.queue.put(None)
+            for worker in self.workers:
+                worker.join()
+            self.gmsv.closeOutput()
+            if self.address.startswith("unix:") and os.path.exists(self.address[len("unix:"):]):
+                os.remove(self.address[len("unix:"):])
+
+    def stop(self,*args):
+        ''' SIGTERM handler: leave serve_forever and finish the queued requests '''
+        raise KeyboardInterrupt
+
+    def getFixed(self):
+        ''' In tar mode every request writes through the one shard writer, so IMGDIR is fixed too '''
+        return self.FIXED + (('IMGDIR',) if self.gmsv.getSetting("OUTPUTMODE") == "tar" else ())
+
+    def handle(self,method,body):
+        ''' Queue one request and wait for it; returns (HTTP status, JSON-able result) '''
+        if method not in self.METHODS:
+            return 404, {'error':"Unknown method {}; use one of {}".format(method,list(self.METHODS))}
+        overrides = body.get('settings') or {}
+        fixed = [key for key in overrides if key in self.getFixed()]
+        if fixed:
+            return 400, {'error':"Settings {} cannot be changed per request".format(fixed)}
+        job = {'method':method,'body':body,'settings':overrides,'done':threading.Event()}
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            self.gmsv.metrics.incr("service_rejected")
+            return 503, {'error':"Queue full"}
+        job['done'].wait()
+        return job['status'], job['result']
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                with self.gmsv.metrics.timer("service_" + job['method']):
+                    with self.gmsv.requestSettings(dict({'PLOTON':False},**job['settings'])):
+                        job['result'] = self.run(job['method'],job['body'])
+                job['status'] = 200
+            except (KeyError,ValueError,TypeError) as e:
+                job['status'], job['result'] = 400, {'error':"Bad request: {}".format(e)}
+            except Exception as e:
+                self.logger.error("{} failed: {}".format(job['method'],e))
+                job['status'], job['result'] = 500, {'error':str(e)}
+            finally:
+                job['done'].set()
+
+    def run(self,method,body):
+        gmsv = self.gmsv
+        rtname = body.get('rtname') or method.upper()
+        if method == 'runAddress':
+            return self.summarize(gmsv.runAddress(body['address']))
+        if method == 'runPt':
+            pt = {'lat':float(body['lat']),'lng':float(body['lng'])}
+            if body.get('alt') is not None:
+                pt['alt'] = int(round(float(body['alt'])))
+            return self.summarize(gmsv.runPtSafe(pt,rtname))
+        if method == 'runPt2Pt':
+            pathresult = gmsv.runPt2Pt(body['points'],rtname,int(body.get('numpts') or gmsv.getSetting("LINEPTS") or 4))
+        elif method == 'runDirections':
+            pathresult = gmsv.runDirections(body['route'],rtname)
+            if pathresult == -1:
+                raise ValueError("Bad route string: {}".format(body['route']))
+        else:
+            pathresult = gmsv.runKML(body['kmlfile'],rtname,body.get('namefilter'))
+        return [self.summarize(res) for res in pathresult]
+
+    def summarize(self,loc):
+        ''' The JSON-able part of a point result (the request parameters hold the API key) '''
+        summary = {key:loc[key] for key in ('lat','lng','alt','pano_id','images','error') if key in loc}
+        summary['status'] = loc.get('status','OK')
+        return summary
+
+    def status(self):
+        return {'queued':self.queue.qsize(),'workers':len(self.workers),'http':self.gmsv.getHttpStats(),
+                'usage':self.gmsv.scheduler.stats(),'counters':self.gmsv.metrics.snapshot()['counters']}
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+    pass
+
+
+class GMapServiceHandler(BaseHTTPRequestHandler):
+    ''' POST /<method> with a JSON body; GET /status '''
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(body,dict):
+                raise ValueError("body is not a JSON object")
+        except ValueError as e:
+            return self.reply(400,{'error':"Bad JSON: {}".format(e)})
+        self.reply(*self.server.service.handle(self.path.strip("/"),body))
+
+    def do_GET(self):
+        if self.path.strip("/") == "status":
+            return self.reply(200,self.server.service.status())
+        self.reply(404,{'error':"Unknown path {}".format(self.path)})
+
+    def reply(self,status,result):
+        data = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self,fmt,*args):
+        logging.getLogger(LOGNAME).debug("service: " + fmt % args)
+
+
+class PointRecord(object):
+    ''' Compact result of one point of a streamed route (see iterPtLst) '''
+    __slots__ = ('lat','lng','alt','status','pano_id','images','error')
+
+    def __init__(self,lat,lng,alt=None,status='OK',pano_id=None,images=(),error=None):
+        self.lat = lat
+        self.lng = lng
+        self.alt = alt
+        self.status = status
+        self.pano_id = pano_id
+        self.images = images
+        self.error = error
+
+    @classmethod
+    def fromResult(cls,res):
+        return cls(float(res['lat']),float(res['lng']),res.get('alt'),res.get('status','OK'),
+                   res.get('pano_id') or (res.get('metadata') or {}).get('pano_id'),
+                   tuple(res.get('images') or ()),res.get('error'))
+
+    def asDict(self):
+        return {key:getattr(self,key) for key in self.__slots__}
+
+    def __repr__(self):
+        return "PointRecord({})".format(", ".join("{}={!r}".format(key,getattr(self,key)) for key in self.__slots__))
+
+
+class QuotaExceeded(Exception):
+    ''' Raised when a call would exceed the per-run or per-day spend budget '''
+    pass
+
+
+class QuotaScheduler(object):
+    ''' Token bucket per API (QPS setting) plus per-run (RUNBUDGET) and per-day (DAYBUDGET)
+        spend caps, charged at COSTS per successful call. Usage per day is kept in USAGEFILE
+        so the daily cap holds across restarts and across processes sharing the file. When the
+        budget is nearly spent, low priority calls (LOWPRIORITY, e.g. maps) are refused first,
+        leaving BUDGETRESERVE of it for images '''
+    def __init__(self,settings,logger=None):
+        self.logger = logger if logger is not None else logging.getLogger(LOGNAME)
+        self.lock = threading.Lock()
+        self.qps = dict(settings.get('QPS') or {})
+        self.costs = dict(settings.get('COSTS') or {})
+        self.runbudget = float(settings.get('RUNBUDGET') or 0)
+        self.daybudget = float(settings.get('DAYBUDGET') or 0)
+        self.reserve_share = float(settings.get('BUDGETRESERVE') or 0)
+        self.lowpriority = set(settings.get('LOWPRIORITY') or [])
+        ''' Usage is only kept on disk when asked to, or when a daily budget needs it '''
+        self.usagefile = settings.get('USAGEFILE') or (USAGEFILE if self.daybudget else None)
+        self.buckets = {}
+        self.runcost = 0.0
+        self.pending = 0.0
+        self.runcalls = {}
+        self.usage = self.loadUsage()
+        self.unsaved = {}
+        self.lastsave = 0.0
+        self.savelock = threading.Lock()
+        if self.usagefile:
+            atexit.register(self.save)
+
+    def today(self):
+        return datetime.now().strftime('%Y-%m-%d')
+
+    @contextmanager
+    def call(self,api):
+        ''' Reserve the cost of one call to api and wait for a token. The cost is spent when
+            the block leaves call['spent'] True and released if it clears it or raises '''
+        self.reserve(api)
+        call = {'spent':True}
+        try:
+            self.waitToken(api)
+            yield call
+        except BaseException:
+            call['spent'] = False
+            raise
+        finally:
+            self.settle(api,call['spent'])
+
+    def reserve(self,api):
+        cost = self.costs.get(api,0.0)
+        with self.lock:
+            if cost:
+                budgetshare = 1.0 - self.reserve_share if api in self.lowpriority else 1.0
+                runcost = self.runcost + self.pending
+                daycost = self.usage.get(self.today(),{}).get('cost',0.0) + self.pending
+                if self.runbudget and runcost + cost > self.runbudget*budgetshare:
+                    raise QuotaExceeded("run budget {} spent ({:.3f})".format(self.runbudget,runcost))
+                if self.daybudget and daycost + cost > self.daybudget*budgetshare:
+                    raise QuotaExceeded("daily budget {} spent ({:.3f})".format(self.daybudget,daycost))
+            self.pending += cost
+
+    def waitToken(self,api):
+        rate = float(self.qps.get(api) or 0)
+        if rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                tokens, last = self.buckets.get(api,(max(rate,1.0),now))
+                tokens = min(max(rate,1.0),tokens + (now - last)*rate)
+                if tokens >= 1.0:
+                    self.buckets[api] = (tokens - 1.0,now)
+                    return
+                self.buckets[api] = (tokens,now)
+                wait = (1.0 - tokens)/rate
+            time.sleep(wait)
+
+    def settle(self,api,spent):
+        cost = self.costs.get(api,0.0)
+        with self.lock:
+            self.pending -= cost
+            if not spent:
+                return
+            self.runcost += cost
+            self.runcalls[api] = self.runcalls.get(api,0) + 1
+            for usage in (self.usage,self.unsaved):
+                addUsage(usage,{self.today():{'cost':cost,'calls':{api:1}}})
+            save = time.monotonic() - self.lastsave > 1.0
+        if save:
+            self.save()
+
+    def loadUsage(self):
+        if not (self.usagefile and os.path.isfile(self.usagefile)):
+            return {}
+        try:
+            with open(self.usagefile) as ufile:
+                return json.load(ufile)
+        except ValueError:
+            self.logger.error("Ignoring damaged usage file {}".format(self.usagefile))
+            return {}
+
+    def save(self):
+        ''' Add the spend since the last save to USAGEFILE under a file lock, so that processes
+            sharing it (e.g. shard workers) add up instead of overwriting each other, and take
+            up their spend for the daily budget '''
+        if not self.usagefile:
+            return
+        with self.savelock:
+            with self.lock:
+                self.lastsave = time.monotonic()
+                unsaved, self.unsaved = self.unsaved, {}
+            try:
+                with lockFile(self.usagefile + ".lock"):
+                    usage = self.loadUsage()
+                    addUsage(usage,unsaved)
+                    writeAtomic(self.usagefile,json.dumps(usage,indent=4).encode())
+            except:
+                with self.lock:
+                    addUsage(self.unsaved,unsaved)
+                raise
+            with self.lock:
+                ''' Keep the spend settled while the file was being written '''
+                addUsage(usage,self.unsaved)
+                self.usage = usage
+
+    def stats(self):
+        with self.lock:
+            return {'runcost':round(self.runcost,4),'calls':dict(self.runcalls),
+                    'daycost':round(self.usage.get(self.today(),{}).get('cost',0.0),4)}
+
+
+class Metrics(object):
+    ''' Thread-safe per-stage wall-time histograms and labelled counters for a GMapView '''
+    BUCKETS = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0,60.0)
+    ''' What the label of each labelled counter means, for the Prometheus export '''
+    LABELNAMES = {'api_calls':'endpoint','bytes_downloaded':'endpoint','images_dropped':'reason'}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def timer(self,stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage,time.perf_counter() - start)
+
+    def observe(self,stage,seconds):
+        with self.lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                hist = self.stages[stage] = {'count':0,'sum':0.0,'max':0.0,'buckets':[0]*len(self.BUCKETS)}
+            hist['count'] += 1
+            hist['sum'] += seconds
+            hist['max'] = max(hist['max'],seconds)
+            for ii, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist['buckets'][ii] += 1
+                    break
+
+    def incr(self,name,label="",value=1):
+        with self.lock:
+            self.counters[(name,label)] = self.counters.get((name,label),0) + value
+
+    def snapshot(self):
+        with self.lock:
+            counters = {}
+            for (name,label), value in self.counters.items():
+                counters.setdefault(name,{})[label or "total"] = value
+            return {'elapsed':time.time() - self.started,
+                    'stages':{stage:dict(hist,buckets=list(hist['buckets'])) for stage, hist in self.stages.items()},
+                    'buckets':list(self.BUCKETS),
+                    'counters':counters}
+
+    def writeJSON(self,fn):
+        writeAtomic(fn,json.dumps(self.snapshot(),indent=4).encode())
+
+    def writePrometheus(self,fn):
+        ''' Write a node_exporter textfile collector file '''
+        snap = self.snapshot()
+        lines = ["# TYPE gmapview_stage_seconds histogram"]
+        for stage, hist in sorted(snap['stages'].items()):
+            cumulative = 0
+            for bound, count in zip(snap['buckets'],hist['buckets']):
+                cumulative += count
+                lines.append('gmapview_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage,bound,cumulative))
+            lines.append('gmapview_stage_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(stage,hist['count']))
+            lines.append('gmapview_stage_seconds_sum{{stage="{}"}} {}'.format(stage,hist['sum']))
+            lines.append('gmapview_stage_seconds_count{{stage="{}"}} {}'.format(stage,hist['count']))
+        for name, labels in sorted(snap['counters'].items()):
+            lines.append("# TYPE gmapview_{}_total counter".format(name))
+            for label, value in sorted(labels.items()):
+                if label == "total":
+                    lines.append('gmapview_{}_total {}'.format(name,value))
+                else:
+                    lines.append('gmapview_{}_total{{{}="{}"}} {}'.format(name,self.LABELNAMES.get(name,"label"),label,value))
+        writeAtomic(fn,("\n".join(lines) + "\n").encode())
+
+    def summary(self):
+        snap = self.snapshot()
+        lines = ["Run time {:.2f}s".format(snap['elapsed']),
+                 "{:<16}{:>8}{:>12}{:>12}{:>12}".format("stage","count","total s","mean ms","max ms")]
+        for stage, hist in sorted(snap['stages'].items(),key=lambda item: -item[1]['sum']):
+            lines.append("{:<16}{:>8}{:>12.3f}{:>12.1f}{:>12.1f}".format(stage,hist['count'],hist['sum'],
+                         1000*hist['sum']/hist['count'],1000*hist['max']))
+        for name, labels in sorted(snap['counters'].items()):
+            lines.append("{}: {}".format(name,", ".join("{}={}".format(label,value) for label, value in sorted(labels.items()))))
+        return "\n".join(lines)
+
+
+class ContactSheetWriter(object):
+    ''' Renders PNG contact sheets of downloaded images on a background thread with Pillow.
+        Per-point sheets hold every heading (and the map, if any); route sheets hold the
+        first image of each point and are written in pages of pagesize thumbnails '''
+    def __init__(self,sheetdir,thumbsize=(240,120),ncols=4,pagesize=64,logger=None,metrics=None):
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.sheetdir = sheetdir
+        self.thumbsize = thumbsize
+        self.ncols = ncols
+        self.pagesize = pagesize
+        self.logger = logger if logger is not None else logging.getLogger(LOGNAME)
+        self.routes = {}
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.run,name="contactsheets",daemon=True)
+        self.worker.start()
+
+    def addPoint(self,name,title,imfiles,mapfetch=None,cleanup=[],route=None,perpoint=True):
+        self.queue.put(('point',(name,title,imfiles,mapfetch,cleanup,route,perpoint)))
+
+    def endRoute(self,route):
+        self.queue.put(('route',route))
+
+    def close(self):
+        ''' Finish the queued sheets and stop the worker '''
+        if self.worker.is_alive():
+            self.queue.put(None)
+            self.worker.join()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                for route in list(self.routes):
+                    self.writeRoute(route)
+                break
+            try:
+                with self.metrics.timer("contactsheet"):
+                    if task[0] == 'point':
+                        self.renderPoint(*task[1])
+                    else:
+                        self.writeRoute(task[1])
+            except Exception as e:
+                self.logger.error("Contact sheet failed: {}".format(e))
+
+    def thumbnail(self,im):
+        im.draft('RGB',self.thumbsize)
+        im = im.convert('RGB')
+        im.thumbnail(self.thumbsize)
+        return im
+
+    def renderPoint(self,name,title,imfiles,mapfetch,cleanup,route,perpoint):
+        thumbs = []
+        for fn in imfiles:
+            with Image.open(fn) as im:
+                thumbs.append(self.thumbnail(im))
+        if perpoint:
+            mapim = mapfetch() if mapfetch is not None else None
+            if mapim is not None:
+                thumbs.append(self.thumbnail(mapim))
+                mapim.close()
+                if os.path.isfile(mapim.filename):
+                    os.remove(mapim.filename)
+            self.writeSheet(thumbs,title,"SHEET_{}.png".format(name))
+        elif thumbs:
+            page = self.routes.setdefault(route,{'thumbs':[],'pages':0})
+            page['thumbs'].append(thumbs[0])
+            if len(page['thumbs']) >= self.pagesize:
+                self.writeRoute(route,final=False)
+        for fn in cleanup:
+            if os.path.isfile(fn):
+                os.remove(fn)
+
+    def writeRoute(self,route,final=True):
+        page = self.routes.get(route)
+        if page is None:
+            return
+        if page['thumbs']:
+            self.writeSheet(page['thumbs'],"{} ({})".format(route,page['pages'] + 1),
+                            "ROUTE_{}_{:04d}.png".format(route,page['pages']))
+            page['thumbs'] = []
+            page['pages'] += 1
+        if final:
+            del self.routes[route]
+
+    def writeSheet(self,thumbs,title,fn):
+        if not thumbs:
+            return
+        tw, th = self.thumbsize
+        ncols = min(self.ncols,len(thumbs))
+        nrows = int(ceil(len(thumbs)/ncols))
+        header = 20
+        sheet = Image.new('RGB',(ncols*tw,header + nrows*th),'white')
+        ImageDraw.Draw(sheet).text((4,4),title,fill='black')
+        for ii, thumb in enumerate(thumbs):
+            sheet.paste(thumb,((ii % ncols)*tw,header + (ii//ncols)*th))
+        os.makedirs(self.sheetdir,exist_ok=True)
+        out = io.BytesIO()
+        sheet.save(out,'PNG')
+        writeAtomic(os.path.join(self.sheetdir,fn),out.getvalue())
+        self.logger.debug("Wrote contact sheet {}".format(fn))
+
+
+class TarShardWriter(object):
+    ''' Appends images to size-bounded tar shards <prefix>-NNNNNN.tar in outdir. Every shard
+        has a sidecar index <prefix>-NNNNNN.idx.jsonl with one line per image holding its
+        metadata and the offset and size of its data in the tar, so a reader can seek
+        straight to any image (see readTarImage) without scanning the archive '''
+    def __init__(self,outdir,maxbytes,prefix=None,logger=None):
+        self.outdir = outdir
+        self.maxbytes = maxbytes
+        self.prefix = prefix if prefix is not None else \
+                "GSV_{}_{}".format(humandate(time.time())[:-7],uuid.uuid4().hex[:8])
+        self.logger = logger if logger is not None else logging.getLogger(LOGNAME)
+        self.lock = threading.Lock()
+        self.shard = -1
+        self.tar = None
+        self.index = None
+        self.tarfn = None
+        self.count = 0
+        os.makedirs(outdir,exist_ok=True)
+
+    def add(self,name,data,meta):
+        ''' Append one image and its index line; returns the reference "<tar file>#<name>" '''
+        with self.lock:
+            if self.tar is None or (self.count and self.tar.offset + len(data) > self.maxbytes):
+                self.roll()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.tar.addfile(info,io.BytesIO(data))
+            self.tar.members = []  # TarFile remembers every member; keep memory flat
+            self.count += 1
+            ''' The data ends the archive so far, padded to a whole block '''
+            offset = self.tar.offset - -(-info.size//tarfile.BLOCKSIZE)*tarfile.BLOCKSIZE
+            rec = dict(meta)
+            rec.update({'name':name,'shard':os.path.basename(self.tarfn),'offset':offset,'size':info.size})
+            self.tar.fileobj.flush()
+            self.index.write(json.dumps(rec) + "\n")
+            self.index.flush()
+            return "{}#{}".format(self.tarfn,name)
+
+    def roll(self):
+        ''' Finish the current shard and start the next; lock must be held '''
+        self.closeShard()
+        self.shard += 1
+        self.tarfn = os.path.join(self.outdir,"{}-{:06d}.tar".format(self.prefix,self.shard))
+        self.tar = tarfile.open(self.tarfn,'w')
+        self.count = 0
+        self.index = open(os.path.join(self.outdir,"{}-{:06d}.idx.jsonl".format(self.prefix,self.shard)),'w')
+        self.logger.debug("Writing images to {}".format(self.tarfn))
+
+    def closeShard(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.index.close()
+            self.tar = None
+            self.index = None
+
+    def close(self):
+        with self.lock:
+            self.closeShard()
+
+
+class DerivativeWriter(object):
+    ''' Makes resized and re-encoded copies of saved images in a pool of worker processes.
+        Images are handed over as the JPEG bytes already in memory. At most maxpending are
+        in flight at once; submit blocks when the pool falls behind, so memory stays bounded '''
+    def __init__(self,specs,workers=0,maxpending=0,logger=None,metrics=None):
+        self.specs = specs
+        self.logger = logger if logger is not None else logging.getLogger(LOGNAME)
+        self.metrics = metrics if metrics is not None else Metrics()
+        workers = workers or os.cpu_count() or 1
+        self.slots = threading.BoundedSemaphore(maxpending or 2*workers)
+        self.lock = threading.Lock()
+        self.pending = set()
+        ''' Spawned rather than forked: the pipeline is multi-threaded '''
+        self.pool = ProcessPoolExecutor(max_workers=workers,mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self,data,exifbytes,outdir,name):
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(makeDerivatives,data,exifbytes,self.specs,outdir,name)
+        except:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+
+    def done(self,future):
+        with self.lock:
+            self.pending.discard(future)
+        self.slots.release()
+        try:
+            self.metrics.incr("derivatives_written",value=len(future.result()))
+        except Exception as e:
+            self.logger.error("Derivatives failed: {}".format(e))
+
+    def flush(self):
+        ''' Wait for every submitted image '''
+        with self.lock:
+            pending = list(self.pending)
+        futures.wait(pending)
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown(wait=True)
+
+
+class GeocodeStore(object):
+    ''' Address to location store with O(1) lookup, kept in an append-only JSON lines log.
+        An ADDRESSFILE in the old single-document format ({'addresses':{...}}) is migrated
+        into a .jsonl file beside it the first time it is opened '''
+    def __init__(self,addressfile,logger=None):
+        self.logger = logger if logger is not None else logging.getLogger(LOGNAME)
+        self.lock = threading.Lock()
+        self.addresses = {}
+        root, ext = os.path.splitext(addressfile)
+        self.logfile = addressfile if ext == ".jsonl" else root + ".jsonl"
+        if os.path.isfile(self.logfile):
+            self.load()
+        elif os.path.isfile(addressfile) and addressfile != self.logfile:
+            self.migrate(addressfile)
+        else:
+            self.logger.info("%s does not exist" % self.logfile)
+
+    def load(self):
+        with open(self.logfile) as lfile:
+            for line in lfile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    self.logger.error("Skipping damaged line in {}".format(self.logfile))
+                    continue
+                self.addresses[entry['address']] = entry['location']
+
+    def migrate(self,addressfile):
+        with open(addressfile) as jfile:
+            addresses = json.load(jfile).get('addresses',{})
+        self.logger.info("Migrating {} addresses from {} to {}".format(len(addresses),addressfile,self.logfile))
+        tmpfn = self.logfile + ".tmp"
+        with open(tmpfn,'w') as lfile:
+            for addr, locdict in addresses.items():
+                lfile.write(json.dumps({'address':addr,'location':locdict}) + "\n")
+        os.replace(tmpfn,self.logfile)
+        self.addresses.update(addresses)
+
+    def get(self,addr):
+        return self.addresses.get(addr)
+
+    def put(self,addr,locdict):
+        with self.lock:
+            self.addresses[addr] = locdict
+            with open(self.logfile,'a') as lfile:
+                lfile.write(json.dumps({'address':addr,'location':locdict}) + "\n")
+
+
+class HashIndex(object):
+    ''' Near-duplicate index of 64-bit perceptual hashes. Each hash is split into distance+1
+        bands; two hashes at most distance bits apart agree exactly on at least one band, so
+        a lookup only compares the entries filed under its own band values. Bands are kept
+        at least 4 bits wide, so distance is limited to MAXDISTANCE. With hashfile the entries
+        are also kept in an append-only JSON lines log and reloaded next run '''
+    MAXDISTANCE = 15
+
+    def __init__(self,distance,hashfile=None,logger=None):
+        if not 0 <= distance <= self.MAXDISTANCE:
+            raise ValueError("DEDUPDISTANCE must be between 0 and {}, not {}".format(self.MAXDISTANCE,distance))
+        self.logger = logger if logger is not None else logging.getLogger(LOGNAME)
+        self.lock = threading.Lock()
+        self.distance = distance
+        nbands = distance + 1
+        self.bounds = [64*ii//nbands for ii in range(nbands + 1)]
+        self.buckets = [{} for _ in range(nbands)]
+        self.hashfile = hashfile
+        if hashfile and os.path.isfile(hashfile):
+            with open(hashfile) as hfile:
+                for line in hfile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        self.logger.error("Skipping damaged line in {}".format(hashfile))
+                        continue
+                    self.add(int(entry['hash'],16),entry['ref'])
+
+    def bands(self,imhash):
+        return [(imhash >> lo) & ((1 << (hi - lo)) - 1) for lo, hi in zip(self.bounds[:-1],self.bounds[1:])]
+
+    def add(self,imhash,ref):
+        for bucket, band in zip(self.buckets,self.bands(imhash)):
+            bucket.setdefault(band,[]).append((imhash,ref))
+
+    def find(self,imhash):
+        for bucket, band in zip(self.buckets,self.bands(imhash)):
+            for other, ref in bucket.get(band,()):
+                if hamming(imhash,other) <= self.distance:
+                    return ref
+        return None
+
+    def match(self,imhash,ref):
+        ''' The ref of an indexed near-duplicate of imhash; if there is none, imhash is
+            indexed as ref and None is returned '''
+        with self.lock:
+            found = self.find(imhash)
+            if found is None:
+                self.add(imhash,ref)
+                if self.hashfile:
+                    with open(self.hashfile,'a') as hfile:
+                        hfile.write(json.dumps({'hash':"{:016x}".format(imhash),'ref':ref}) + "\n")
+            return found
+
+
+class ImageCache(object):
+    ''' Persistent content-addressed cache of downloaded files with an LRU size budget.
+        Files are stored as <cachedir>/<key[:2]>/<key><ext>; an sqlite index in the cache
+        directory tracks their size and last use so the least recently used are evicted first '''
+    def __init__(self,cachedir,maxbytes,ext=".jpg",logger=None):
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self.ext = ext
+        self.logger = logger if logger is not None else logging.getLogger(LOGNAME)
+        self.lock = threading.Lock()
+        os.makedirs(cachedir,exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(cachedir,"index.sqlite"),check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, atime REAL, note TEXT)")
+        if 'note' not in [row[1] for row in self.db.execute("PRAGMA table_info(entries)")]:
+            self.db.execute("ALTER TABLE entries ADD COLUMN note TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+        self.db.commit()
+        self.totalbytes = self.db.execute("SELECT COALESCE(SUM(size),0) FROM entries").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def makeKey(**params):
+        return hashlib.sha1(json.dumps(params,sort_keys=True).encode()).hexdigest()
+
+    def getPath(self,key):
+        return os.path.join(self.cachedir,key[:2],key + self.ext)
+
+    def contains(self,key):
+        ''' Check for a usable entry and count the hit or miss '''
+        with self.lock:
+            row = self.db.execute("SELECT size FROM entries WHERE key=? AND note IS NULL",(key,)).fetchone()
+            if row is not None and not os.path.isfile(self.getPath(key)):
+                self.forget(key,row[0])
+                row = None
+            if row is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+            self.db.execute("UPDATE entries SET atime=? WHERE key=?",(time.time(),key))
+            self.db.commit()
+            return True
+
+    def materialize(self,key,dstfn):
+        ''' Hardlink the cached file to dstfn, falling back to a copy across filesystems '''
+        try:
+            linkOrCopy(self.getPath(key),dstfn)
+        except OSError as e:
+            self.logger.error("Cache entry {} unusable: {}".format(key,e))
+            return False
+        return True
+
+    def read(self,key):
+        ''' The contents of a cached file, or None if it cannot be read '''
+        try:
+            with open(self.getPath(key),'rb') as f:
+                return f.read()
+        except OSError as e:
+            self.logger.error("Cache entry {} unusable: {}".format(key,e))
+            return None
+
+    def put(self,key,srcfn):
+        cachefn = self.getPath(key)
+        os.makedirs(os.path.dirname(cachefn),exist_ok=True)
+        try:
+            linkOrCopy(srcfn,cachefn)
+        except OSError as e:
+            self.logger.error("Could not cache {}: {}".format(srcfn,e))
+            return
+        self.record(key)
+
+    def putData(self,key,data):
+        cachefn = self.getPath(key)
+        os.makedirs(os.path.dirname(cachefn),exist_ok=True)
+        try:
+            writeAtomic(cachefn,data)
+        except OSError as e:
+            self.logger.error("Could not cache {}: {}".format(key,e))
+            return
+        self.record(key)
+
+    def getNote(self,key):
+        ''' The note stored for key in place of a file (see putNote), or None '''
+        with self.lock:
+            row = self.db.execute("SELECT note FROM entries WHERE key=? AND note IS NOT NULL",(key,)).fetchone()
+            if row is None:
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE entries SET atime=? WHERE key=?",(time.time(),key))
+            self.db.commit()
+            return row[0]
+
+    def putNote(self,key,note):
+        ''' Remember that key was fetched but not kept (e.g. an image dropped by the content
+            filter), so it is not fetched again; notes take no space and age out like files '''
+        with self.lock:
+            row = self.db.execute("SELECT size FROM entries WHERE key=?",(key,)).fetchone()
+            self.totalbytes -= row[0] if row is not None else 0
+            self.db.execute("INSERT OR REPLACE INTO entries (key,size,atime,note) VALUES (?,0,?,?)",(key,time.time(),note))
+            self.db.commit()
+        if os.path.isfile(self.getPath(key)):
+            os.remove(self.getPath(key))
+
+    def record(self,key):
+        ''' Account for a newly stored entry and evict to fit the budget '''
+        size = os.path.getsize(self.getPath(key))
+        with self.lock:
+            row = self.db.execute("SELECT size FROM entries WHERE key=?",(key,)).fetchone()
+            self.totalbytes += size - (row[0] if row is not None else 0)
+            self.db.execute("INSERT OR REPLACE INTO entries (key,size,atime) VALUES (?,?,?)",(key,size,time.time()))
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        ''' Drop least recently used entries until the cache fits its budget; lock must be held '''
+        while self.totalbytes > self.maxbytes:
+            row = self.db.execute("SELECT key,size FROM entries ORDER BY atime LIMIT 1").fetchone()
+            if row is None:
+                break
+            self.forget(*row)
+            self.evictions += 1
+
+    def forget(self,key,size):
+        self.db.execute("DELETE FROM entries WHERE key=?",(key,))
+        self.totalbytes -= size
+        if os.path.isfile(self.getPath(key)):
+            os.remove(self.getPath(key))
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {'hits':self.hits,'misses':self.misses,'evictions':self.evictions,
+                'entries':entries,'bytes':self.totalbytes}
+
+
+class SpatialIndex(object):
+    ''' Persistent index of saved images by location. Images are bucketed in an sqlite table
+        by grid cell (CELLDEG degrees, about 110 m of latitude); a radius query reads only
+        the rows of cells overlapping its bounding box and filters them by distance '''
+    CELLDEG = 0.001
+    NCOLS = int(round(360/CELLDEG))
+
+    def __init__(self,indexfile,logger=None):
+        self.indexfile = indexfile
+        self.logger = logger if logger is not None else logging.getLogger(LOGNAME)
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(indexfile) or ".",exist_ok=True)
+        self.db = sqlite3.connect(indexfile,timeout=30,check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, cell INTEGER, lat REAL, lng REAL, "
+                        "heading REAL, pitch REAL, pano_id TEXT, route TEXT, path TEXT, time REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS images_cell ON images (cell)")
+        self.db.commit()
+
+    @classmethod
+    def getCell(cls,lat,lng):
+        return cls.getRow(lat)*cls.NCOLS + cls.getCol(lng)
+
+    @classmethod
+    def getRow(cls,lat):
+        return min(int((min(max(lat,-90.0),90.0) + 90.0)/cls.CELLDEG),cls.NCOLS//2 - 1)
+
+    @classmethod
+    def getCol(cls,lng):
+        return min(int((min(max(lng,-180.0),180.0) + 180.0)/cls.CELLDEG),cls.NCOLS - 1)
+
+    @classmethod
+    def getColSpans(cls,lng0,lng1):
+        ''' The column ranges covering longitudes lng0 to lng1, split in two where they wrap
+            around the antimeridian '''
+        if lng1 - lng0 >= 360.0:
+            return [(0,cls.NCOLS - 1)]
+        if lng0 < -180.0:
+            return [(cls.getCol(lng0 + 360.0),cls.NCOLS - 1),(0,cls.getCol(lng1))]
+        if lng1 > 180.0:
+            return [(cls.getCol(lng0),cls.NCOLS - 1),(0,cls.getCol(lng1 - 360.0))]
+        return [(cls.getCol(lng0),cls.getCol(lng1))]
+
+    def add(self,reclst):
+        ''' Index the images of one point: dicts with lat, lng, heading, pitch, pano_id, rtname and path '''
+        now = time.time()
+        rows = [(self.getCell(rec['lat'],rec['lng']),rec['lat'],rec['lng'],float(rec['heading']),
+                 float(rec.get('pitch') or 0),rec.get('pano_id'),rec.get('rtname'),rec['path'],now) for rec in reclst]
+        with self.lock:
+            self.db.executemany("INSERT INTO images (cell,lat,lng,heading,pitch,pano_id,route,path,time) "
+                                "VALUES (?,?,?,?,?,?,?,?,?)",rows)
+            self.db.commit()
+
+    def query(self,lat,lng,radius,headings=None):
+        ''' Images within radius metres of lat,lng (optionally only at the given headings),
+            nearest first, each with its distance in metres '''
+        dlat = degrees(radius/EARTHRADIUS)
+        dlng = dlat/max(cos(radians(lat)),1e-6)
+        colspans = self.getColSpans(lng - dlng,lng + dlng)
+        wanted = None if headings is None else set(round(float(heading)) % 360 for heading in headings)
+        found = []
+        with self.lock:
+            for row in range(self.getRow(lat - dlat),self.getRow(lat + dlat) + 1):
+                for col0, col1 in colspans:
+                    found.extend(self.db.execute("SELECT lat,lng,heading,pitch,pano_id,route,path,time FROM images "
+                            "WHERE cell BETWEEN ? AND ?",(row*self.NCOLS + col0,row*self.NCOLS + col1)))
+        reslst = []
+        for ilat, ilng, heading, pitch, pano_id, route, path, itime in found:
+            if wanted is not None and round(heading) % 360 not in wanted:
+                continue
+            dist = haversine(lat,lng,ilat,ilng)
+            if dist <= radius:
+                reslst.append({'lat':ilat,'lng':ilng,'heading':heading,'pitch':pitch,'pano_id':pano_id,
+                               'route':route,'path':path,'time':itime,'distance':dist})
+        reslst.sort(key=lambda res: res['distance'])
+        return reslst
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+
 ''' General Utility Functions '''
+EARTHRADIUS = 6371008.8
+
+def haversine(lat1,lng1,lat2,lng2):
+    ''' Great-circle distance in metres between two points in degrees '''
+    dlat, dlng = radians(lat2 - lat1), radians(lng2 - lng1)
+    h = sin(dlat/2)**2 + cos(radians(lat1))*cos(radians(lat2))*sin(dlng/2)**2
+    return 2*EARTHRADIUS*asin(min(1.0,sqrt(h)))
+
+RELHEADINGS = {'forward':0.0,'right':90.0,'backward':180.0,'left':270.0}
+
+def pathBearings(lat,lng):
+    ''' Vectorized direction of travel (degrees clockwise from north) at each point of a
+        polyline given as arrays of lat/lng in degrees: the initial great-circle bearing from
+        the previous to the next point (one-sided at the ends). Points whose neighbours
+        coincide take the nearest defined bearing; all NaN if there is none '''
+    npts = len(lat)
+    if npts < 2:
+        return np.full(npts,np.nan)
+    i0 = np.concatenate(([0],np.arange(npts - 2),[npts - 2]))
+    i1 = np.concatenate(([1],np.arange(2,npts),[npts - 1]))
+    phi0, phi1 = np.radians(lat[i0]), np.radians(lat[i1])
+    dlam = np.radians(lng[i1] - lng[i0])
+    bearing = np.degrees(np.arctan2(np.sin(dlam)*np.cos(phi1),
+                                    np.cos(phi0)*np.sin(phi1) - np.sin(phi0)*np.cos(phi1)*np.cos(dlam))) % 360
+    valid = (lat[i0] != lat[i1]) | (lng[i0] != lng[i1])
+    if not valid.any():
+        return np.full(npts,np.nan)
+    ''' Fill forward from the last defined bearing, then backward for the leading points '''
+    idx = np.maximum.accumulate(np.where(valid,np.arange(npts),-1))
+    idx[idx < 0] = np.argmax(valid)
+    return bearing[idx]
+
+def latLng2Vec(lat,lng):
+    ''' Unit vectors (n x 3) for arrays of lat/lng in degrees '''
+    phi, lam = np.radians(lat), np.radians(lng)
+    return np.stack((np.cos(phi)*np.cos(lam),np.cos(phi)*np.sin(lam),np.sin(phi)),axis=-1)
+
+def vec2LatLng(vec):
+    lat = np.degrees(np.arctan2(vec[...,2],np.hypot(vec[...,0],vec[...,1])))
+    lng = np.degrees(np.arctan2(vec[...,1],vec[...,0]))
+    return lat, lng
+
+def slerpVec(va,vb,ang,frac):
+    ''' Spherical interpolation between rows of va and vb separated by angle ang (radians) '''
+    ang = ang[:,None]
+    frac = frac[:,None]
+    sinang = np.sin(ang)
+    small = sinang < 1e-12
+    safe = np.where(small,1.0,sinang)
+    wa = np.where(small,1.0-frac,np.sin((1.0-frac)*ang)/safe)
+    wb = np.where(small,frac,np.sin(frac*ang)/safe)
+    vec = wa*va + wb*vb
+    return vec/np.linalg.norm(vec,axis=-1,keepdims=True)
+
+def slerpLatLng(lat1,lng1,lat2,lng2,frac):
+    ''' Points at fractions frac of the way along the great circle from (lat1,lng1) to (lat2,lng2) '''
+    va = np.repeat(latLng2Vec(lat1,lng1),len(frac),axis=0)
+    vb = np.repeat(latLng2Vec(lat2,lng2),len(frac),axis=0)
+    ang = np.arctan2(np.linalg.norm(np.cross(va,vb),axis=-1),np.sum(va*vb,axis=-1))
+    return vec2LatLng(slerpVec(va,vb,ang,np.asarray(frac,dtype=float)))
+
+def densifyPath(lat,lng,spacing,alt=None):
+    ''' Vectorized resampling of a polyline (arrays of lat/lng in degrees) at a fixed spacing in
+        metres of great-circle distance. Returns arrays lat, lng and alt (None if alt is None) '''
+    vec = latLng2Vec(lat,lng)
+    va, vb = vec[:-1], vec[1:]
+    ang = np.arctan2(np.linalg.norm(np.cross(va,vb),axis=-1),np.sum(va*vb,axis=-1))
+    cumdist = np.concatenate(([0.0],np.cumsum(ang*EARTHRADIUS)))
+    sdist = np.arange(0.0,cumdist[-1],spacing)
+    seg = np.clip(np.searchsorted(cumdist,sdist,side='right') - 1,0,len(ang) - 1)
+    seglen = cumdist[seg + 1] - cumdist[seg]
+    frac = np.where(seglen > 0,(sdist - cumdist[seg])/np.where(seglen > 0,seglen,1.0),0.0)
+    plat, plng = vec2LatLng(slerpVec(va[seg],vb[seg],ang[seg],frac))
+    plat, plng = np.append(plat,lat[-1]), np.append(plng,lng[-1])
+    palt = None
+    if alt is not None:
+        palt = np.append(alt[seg] + frac*(alt[seg + 1] - alt[seg]),alt[-1])
+    return plat, plng, palt
+
+GEOHASHBASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def geohash(lat,lng,precision=5):
+    ''' Geohash of a point: interleaved longitude/latitude bisection bits, 5 per character '''
+    latrange, lngrange = [-90.0,90.0], [-180.0,180.0]
+    chars = []
+    bits = 0
+    nbits = 0
+    even = True
+    while len(chars) < precision:
+        rng, val = (lngrange,lng) if even else (latrange,lat)
+        mid = (rng[0] + rng[1])/2
+        bits <<= 1
+        if val >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        nbits += 1
+        if nbits == 5:
+            chars.append(GEOHASHBASE32[bits])
+            bits = 0
+            nbits = 0
+    return "".join(chars)
+
+def kmlTag(elem):
+    ''' Element tag without its xml namespace '''
+    return elem.tag.rsplit("}",1)[-1]
+
+def kmlGeometries(elem):
+    ''' Generator over (type, coordinates string) of the Point, LineString, LinearRing and 
+        Polygon outer boundary geometries under a Placemark or MultiGeometry '''
+    for child in elem:
+        tag = kmlTag(child)
+        if tag in ("Point","LineString","LinearRing"):
+            yield tag, child.findtext("{*}coordinates")
+        elif tag == "Polygon":
+            for ring in child.iterfind("{*}outerBoundaryIs/{*}LinearRing"):
+                yield "LinearRing", ring.findtext("{*}coordinates")
+        elif tag == "MultiGeometry":
+            for geom in kmlGeometries(child):
+                yield geom
+
+def kmlCoordinates(coordtext):
+    ''' Generator over the 'lng,lat[,alt]' tuples of a kml coordinates string '''
+    for match in re.finditer(r"\S+",coordtext or ""):
+        coord = match.group(0).split(",")
+        pt = {'lat':float(coord[1]),'lng':float(coord[0])}
+        if len(coord) > 2 and coord[2]:
+            pt['alt'] = int(round(float(coord[2])))
+        yield pt
+
+def gpsExif(lat,lng,alt=0):
+    ''' EXIF block holding just the GPS position of an image '''
+    def dms(deg):
+        deg = abs(deg)
+        mins = (deg - int(deg))*60
+        return ((int(deg),1),(int(mins),1),(int(round((mins - int(mins))*60*10000)),10000))
+    alt = float(alt or 0)
+    gps = {
+        piexif.GPSIFD.GPSVersionID: (2,0,0,0),
+        piexif.GPSIFD.GPSLatitudeRef: 'N' if lat >= 0 else 'S',
+        piexif.GPSIFD.GPSLatitude: dms(lat),
+        piexif.GPSIFD.GPSLongitudeRef: 'E' if lng >= 0 else 'W',
+        piexif.GPSIFD.GPSLongitude: dms(lng),
+        piexif.GPSIFD.GPSAltitudeRef: 0 if alt >= 0 else 1,
+        piexif.GPSIFD.GPSAltitude: (int(round(abs(alt)*100)),100),
+    }
+    return piexif.dump({"0th":{},"Exif":{},"GPS":gps,"1st":{},"thumbnail":None})
+
+DERIVEXT = {'JPEG':'jpg','WEBP':'webp','PNG':'png'}
+
+def makeDerivatives(data,exifbytes,specs,outdir,name):
+    ''' Process pool worker: write every derivative in specs (dicts with name, size [w,h],
+        format and quality) of one JPEG given as bytes to outdir/<spec name>/<stem>.<ext>,
+        keeping the EXIF block. The JPEG is decoded once, in draft mode at the reduced scale
+        the largest derivative allows, and shrunk from one size to the next '''
+    stem = os.path.splitext(name)[0]
+    outlst = []
+    specs = sorted(specs,key=lambda spec: -spec['size'][0]*spec['size'][1])
+    with Image.open(io.BytesIO(data)) as im:
+        im.draft('RGB',tuple(specs[0]['size']))
+        im = im.convert('RGB')
+    for spec in specs:
+        im.thumbnail(tuple(spec['size']))
+        fmt = spec.get('format','JPEG').upper()
+        out = io.BytesIO()
+        im.save(out,fmt,quality=int(spec.get('quality',85)),exif=exifbytes)
+        outfn = os.path.join(outdir,spec['name'],"{}.{}".format(stem,DERIVEXT.get(fmt,fmt.lower())))
+        os.makedirs(os.path.dirname(outfn),exist_ok=True)
+        writeAtomic(outfn,out.getvalue())
+        outlst.append(outfn)
+    return outlst
+
+def imageHash(jpeg):
+    ''' 64-bit difference hash (dHash) of JPEG bytes, plus the standard deviation of its grey
+        levels. The JPEG is decoded in draft mode at the smallest scale that will do (1/8) '''
+    with Image.open(io.BytesIO(jpeg)) as im:
+        im.draft('L',(64,32))
+        grey = im.convert('L')
+    small = np.asarray(grey.resize((9,8)),dtype=np.int16)
+    imhash = int(np.packbits(small[:,1:] > small[:,:-1]).tobytes().hex(),16)
+    return imhash, float(np.asarray(grey,dtype=float).std())
+
+def hamming(hash1,hash2):
+    return bin(hash1 ^ hash2).count("1")
+
+def insertExif(exifbytes,jpeg):
+    ''' Splice an EXIF block into JPEG bytes (replacing any existing one) without decoding it '''
+    out = io.BytesIO()
+    piexif.insert(exifbytes,jpeg,out)
+    return out.getvalue()
+
+def writeAtomic(fn,data):
+    ''' Write data to fn through a temporary file in the same directory and an atomic rename '''
+    fd, tmpfn = tempfile.mkstemp(prefix=".",suffix=".tmp",dir=os.path.dirname(fn) or ".")
+    try:
+        with os.fdopen(fd,'wb') as f:
+            f.write(data)
+        os.replace(tmpfn,fn)
+    except:
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+        raise
+
+@contextmanager
+def lockFile(lockfn):
+    ''' Hold an exclusive advisory lock on lockfn for the block (no lock without fcntl) '''
+    with open(lockfn,'a') as lfile:
+        if fcntl is not None:
+            fcntl.flock(lfile,fcntl.LOCK_EX)
+        yield
+
+def addUsage(usage,delta):
+    ''' Add per-day {'cost','calls'} usage records from delta into usage '''
+    for date, spent in delta.items():
+        day = usage.setdefault(date,{'cost':0.0,'calls':{}})
+        day['cost'] += spent['cost']
+        for api, calls in spent['calls'].items():
+            day['calls'][api] = day['calls'].get(api,0) + calls
+
+def mergeBySeq(fnlst):
+    ''' Generator over the lines of JSON lines files each sorted by 'seq', merged by 'seq' '''
+    with ExitStack() as stack:
+        streams = [(line if line.endswith("\n") else line + "\n" for line in stack.enter_context(open(fn))
+                    if line.strip()) for fn in fnlst]
+        for line in heapq.merge(*streams,key=lambda line: json.loads(line)['seq']):
+            yield line
+
+def readTarImage(tarfn,offset,size):
+    ''' Read one image straight out of a tar shard using the offset and size from its index '''
+    with open(tarfn,'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+def linkOrCopy(srcfn,dstfn):
+    ''' Hardlink srcfn to dstfn (copying across filesystems) and atomically replace dstfn '''
+    tmpfn = "{}.{}.tmp".format(dstfn,threading.get_ident())
+    try:
+        os.link(srcfn,tmpfn)
+    except OSError:
+        shutil.copyfile(srcfn,tmpfn)
+    os.replace(tmpfn,dstfn)
+
 def gpsdict2pt(dictpt):
     return [dictpt['lng'],dictpt['lat']]
 
@@ -540,15 +2905,61 @@ defaultsettings = {
     'IMGSIZE': '600x300', 
     'PLOTON': False, 
     'SHOWTIME': 4, 
+    'PLOTMODE': 'window',
+    'SHEETDIR': '',
+    'THUMBSIZE': [240,120],
+    'SHEETPAGE': 64,
     'MAPON': True, 
+    'MAPMODE': 'point',
+    'MAPCACHEDIR': '',
+    'MAPCACHESIZE': 256,
     'CLEAN': False, 
+    'OUTPUTMODE': 'files',
+    'TARSIZE': 1024,
+    'DERIVATIVES': [],
+    'DERIVDIR': '',
+    'DERIVWORKERS': 0,
+    'DERIVQUEUE': 0,
+    'CONCURRENCY': 1,
+    'CACHEDIR': '',
+    'CACHESIZE': 1024,
+    'CACHEPRECISION': 5,
+    'INDEXFILE': '',
+    'DEDUP': False,
+    'DEDUPDISTANCE': 4,
+    'DEDUPMODE': 'drop',
+    'DEDUPFILE': '',
+    'PLACEHOLDERHASHES': [],
+    'PLACEHOLDERSTD': 3.0,
+    'COVERRADIUS': 0,
+    'PANODEDUP': False,
+    'PANOCHUNK': 1024,
+    'METRICSFILE': '',
+    'PROMFILE': '',
+    'APIBASE': 'https://maps.googleapis.com',
+    'QPS': {'geocode':50,'directions':50,'streetview':500,'streetview/metadata':500,'staticmap':500},
+    'COSTS': {'geocode':0.005,'directions':0.005,'streetview':0.007,'streetview/metadata':0.0,'staticmap':0.002},
+    'RUNBUDGET': 0,
+    'DAYBUDGET': 0,
+    'BUDGETRESERVE': 0.1,
+    'LOWPRIORITY': ['staticmap'],
+    'USAGEFILE': '',
+    'HTTPTIMEOUT': [5,30],
+    'HTTPRETRIES': 4,
+    'HTTPBACKOFF': 0.5,
     'HEADINGS': '0,90,180,270', 
+    'HEADINGMODE': 'fixed',
+    'RELHEADINGS': 'forward,backward',
     'PITCH': 0, 
     'LINEPTS': 4, 
+    'SPACING': 0,
+    'SHARDPRECISION': 5,
     'XPOS': 100, 
     'YPOS': 100, 
     'FIGWIDTH': 15, 
     'FIGHEIGHT': 15,
+    'SERVICEWORKERS': 4,
+    'SERVICEQUEUE': 64,
     'LOGLEVEL':"DEBUG",
     'ADDRESSFILE': './gmapaddresses.json'
 }
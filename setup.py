@@ -1,7 +1,7 @@
 import pip
 
 INSTALL = True
-instlst = ['googlemaps','google-streetview','xmltodict','GPSPhoto',
-           'Pillow','piexif','exifread','matplotlib','gmaps']
+instlst = ['googlemaps','requests',
+           'Pillow','numpy','piexif','matplotlib','gmaps']
 if INSTALL:
     failed = pip.main(["install"] + instlst)
\ No newline at end of file